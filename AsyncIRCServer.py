@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from qqbot.utf8logger import INFO
+
+from IRCProtocol import LineFramer, parseMessage
+from IRCServer import IRCClientBase, IRCServerBase
+from Lanes import CONTROL, INTERACTIVE, Lanes
+
+# One event loop owns every socket.  Command handlers still block on QQ (the
+# contact directory loads through the qqbot mainloop `Put` queue), so
+# each client's work items run in order on a small shared executor instead of
+# on two dedicated threads per connection.  PING and PONG touch no client
+# state and are answered on the event loop as they arrive, so they cannot
+# starve behind fetches holding every executor worker; everything else,
+# CAP included, keeps its order in the client's queue.  Output is flushed
+# on the event loop too.
+class AsyncIRCClient(IRCClientBase, asyncio.Protocol):
+    loopCommands = frozenset(['PING', 'PONG'])
+
+    def __init__(self, server):
+        self.server = server
+        self.listener = server
+        self.loop = server.loop
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')
+        self.framer = LineFramer()
+        self.senderQueue = Lanes()
+        self.senderReady = asyncio.Event()
+        self.setupClient()
+        self.output.backlog = transport.get_write_buffer_size
+        self.senderTask = self.loop.create_task(self.sender())
+
+    def data_received(self, data):
+        for line in self.framer.feed(data):
+            self.received_(line)
+
+    def received_(self, line):
+        message = parseMessage(line)
+        if message is None:
+            return
+        if message.command in self.loopCommands:
+            self.runTask_(CONTROL, self.processMessage, (message, line), {})
+            self.flush()
+        else:
+            self.sender_putIn(self.laneOf_(message), self.processMessage, message, line)
+
+    def connection_lost(self, exc):
+        INFO("connection_lost() %s" % exc)
+        self.sender_exit()
+
+    def resume_writing(self):
+        self.output.drained()
+
+    def reader_exit(self):
+        INFO("reader_exit()")
+
+    # sender
+    async def sender(self):
+        try:
+            while True:
+                if not self.senderQueue:
+                    self.senderReady.clear()
+                    await self.senderReady.wait()
+                    continue
+                (lane, (f, args, kwargs)) = self.senderQueue.pop()
+                if f is None:
+                    break
+                if f == self.flush:
+                    # only hands chunks to the transport; flushes all run
+                    # here so that chunks are written in order
+                    self.runTask_(lane, f, args, kwargs)
+                    continue
+                await self.loop.run_in_executor(self.listener.executor,
+                        self.runTask_, lane, f, args, kwargs)
+        finally:
+            INFO("sender task exit")
+            self.server.removeClient(self)
+            self.transport.close()
+
+    def sender_putIn(self, lane, f, *args, **kwargs):
+        self.loop.call_soon_threadsafe(self.put_, lane, (f, args, kwargs))
+
+    # on the event loop
+    def put_(self, lane, task):
+        self.senderQueue.put(lane, task)
+        self.senderReady.set()
+
+    def sender_exit(self):
+        self.sender_putIn(INTERACTIVE, None)
+
+    # flushes run on the event loop
+    def writeChunks(self, chunks):
+        self.output.syscalls += 1
+        self.transport.writelines(chunks)
+
+    def abortConnection(self):
+        self.loop.call_soon_threadsafe(self.transport.abort)
+
+    # the work runs on the executor or a sync worker while the sender waits
+    # for it, so the buffer is handed to the transport from here and the
+    # work waits for the client to read it
+    def drain_(self, encoded):
+        if threading.current_thread() is self.server.loopThread:
+            return True
+        self.loop.call_soon_threadsafe(self.flushAll_)
+        return self.output.waitRoom(encoded, self.drainTimeout)
+
+    def flushAll_(self):
+        while self.output.pending:
+            self.flush()
+
+class AsyncIRCServer(IRCServerBase):
+    def __init__(self, bot, address, workers=8):
+        self.setupServer(bot)
+        self.loop = asyncio.new_event_loop()
+        self.loopThread = None
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+                lambda: AsyncIRCClient(self), address[0], address[1], reuse_address=True))
+        self.server_address = self.server.sockets[0].getsockname()
+
+    def serve_forever(self):
+        self.loopThread = threading.current_thread()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+# Recent QQ messages of every dialog (group or buddy), kept on the server so
+# that they outlive the clients.  Each dialog holds at most `maxMessages`
+# messages and `maxBytes` bytes of encoded text; the oldest go first.
+class Backlog(object):
+    def __init__(self, maxMessages=200, maxBytes=65536):
+        self.maxMessages = maxMessages
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.rings = {}
+        self.sizes = {}
+
+    def append(self, message):
+        qq = message.dialog.qq
+        with self.lock:
+            self.seq += 1
+            message.seq = self.seq
+            if self.maxMessages <= 0:
+                return
+
+            ring = self.rings.get(qq)
+            if ring is None:
+                ring = self.rings[qq] = collections.deque()
+                self.sizes[qq] = 0
+            ring.append(message)
+            size = self.sizes[qq] + message.size
+            while len(ring) > 1 and (len(ring) > self.maxMessages or size > self.maxBytes):
+                size -= ring.popleft().size
+            self.sizes[qq] = size
+
+    # messages of dialog `qq` newer than `seq`, oldest first
+    def since(self, qq, seq):
+        with self.lock:
+            ring = self.rings.get(qq)
+            if not ring or ring[-1].seq <= seq:
+                return []
+            return [message for message in ring if message.seq > seq]
+
+    # messages of every dialog newer than `seq`, oldest first
+    def sinceAll(self, seq):
+        with self.lock:
+            messages = [message for ring in self.rings.values()
+                                for message in ring if message.seq > seq]
+        messages.sort(key=lambda message: message.seq)
+        return messages
+
+    def stats(self):
+        with self.lock:
+            return {
+                'dialogs': len(self.rings),
+                'messages': sum(len(ring) for ring in self.rings.values()),
+                'bytes': sum(self.sizes.values()),
+            }
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import re
+
+from supybot import ircutils
+
+class ChannelEntry(object):
+    __slots__ = ('folded', 'channel', 'group', 'users', 'topic')
+
+    def __init__(self, channel, group, users):
+        self.folded = ircutils.toLower(channel)
+        self.channel = channel
+        self.group = group
+        self.users = str(users)
+        self.topic = group.nick + ' | ' + group.mark + ' | '+ group.gcode
+
+# The channels of one name map (named or numeric) for one directory load,
+# sorted by case-folded name so that LIST masks can be answered by a dict
+# lookup (exact names), a bisect (prefix*) or, failing both, a scan.
+class ChannelIndex(object):
+    def __init__(self, generation, nameMap, directory):
+        self.generation = generation
+        entries = []
+        for group in directory.listGroups():
+            channel = nameMap.toIRC.get(group.qq)
+            if channel is not None:
+                entries.append(ChannelEntry(channel, group, directory.memberCount(group.qq)))
+        entries.sort(key=lambda entry: entry.folded)
+        self.entries = entries
+        self.keys = [entry.folded for entry in entries]
+        self.byName = dict((entry.folded, entry) for entry in entries)
+
+    def exact_(self, name):
+        entry = self.byName.get(name)
+        return [entry] if entry else []
+
+    def prefix_(self, prefix):
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            yield self.entries[i]
+            i += 1
+
+    def scan_(self, regex):
+        return (entry for entry in self.entries if regex.match(entry.folded))
+
+    # entries matching any of the comma-separated `masks`, each once
+    def match(self, masks):
+        seen = set()
+        for mask in masks.split(','):
+            if not mask:
+                continue
+            (kind, arg) = compileMask(mask)
+            for entry in getattr(self, kind)(arg):
+                if entry.folded not in seen:
+                    seen.add(entry.folded)
+                    yield entry
+
+maskCache = {}
+
+# IRC masks: `*` and `?` are the only wildcards, matching is case-insensitive
+def compileMask(mask):
+    compiled = maskCache.get(mask)
+    if compiled is None:
+        folded = ircutils.toLower(mask)
+        head = folded.rstrip('*')
+        if '*' not in folded and '?' not in folded:
+            compiled = ('exact_', folded)
+        elif '*' not in head and '?' not in head:
+            compiled = ('prefix_', head)
+        else:
+            pattern = re.escape(folded).replace(r'\*', '.*').replace(r'\?', '.')
+            compiled = ('scan_', re.compile(pattern + r'\Z', re.S))
+        if len(maskCache) >= 256:
+            maskCache.clear()
+        maskCache[mask] = compiled
+    return compiled
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from qqbot.utf8logger import ERROR, EXCEPTION, INFO
+from qqbot.mainloop import StartDaemonThread
+
+from Fetcher import FetchTimeout
+
+# Every group, group member and buddy of the QQ account, shared by all IRC
+# clients of a server.  The directory is loaded in two fetch batches (the
+# group and buddy lists, then every member list); callers arriving while the
+# first load is in flight wait for that load instead of starting their own.
+# Once there are entries, expired ones are served while a background
+# refresh replaces them.  A failed load is retried after `retryDelay`.
+# It may start out with entries from a snapshot, which are served until the
+# first load from QQ (`live`) replaces them.
+class ContactDirectory(object):
+    retryDelay = 30
+
+    def __init__(self, server, ttl=300):
+        self.server = server
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loading = None
+        self.expires = 0
+        self.generation = 0
+        self.live = False
+        self.liveLoaded = threading.Event()
+
+        self.groups = []
+        self.buddies = []
+        self.members = {}
+        self.memberCounts = {}
+        self.groupByQQ = {}
+        self.buddyByQQ = {}
+        self.contactByQQ = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.expires = 0
+
+    def ensure(self):
+        with self.lock:
+            now = time.time()
+            if now < self.expires:
+                if not self.generation:
+                    raise FetchTimeout("the contact directory could not be loaded")
+                return
+            if self.generation:
+                # refresh() leaves expires alone if it fails
+                self.expires = now + self.retryDelay
+                StartDaemonThread(self.refresh)
+                return
+            loading = self.loading
+            isLoader = loading is None
+            if isLoader:
+                loading = self.loading = threading.Event()
+
+        if not isLoader:
+            # the load may have failed; without entries there is nothing to
+            # return to the caller
+            finished = loading.wait(self.server.fetcher.timeout)
+            if not self.generation:
+                raise FetchTimeout("the contact directory could not be loaded" if finished
+                                   else "timed out waiting for the contact directory")
+            return
+
+        try:
+            self.install(*self.load())
+        except FetchTimeout:
+            with self.lock:
+                self.expires = time.time() + self.retryDelay
+            raise
+        finally:
+            with self.lock:
+                self.loading = None
+            loading.set()
+
+    def load(self):
+        bot = self.server.bot
+        with self.server.batch() as batch:
+            groups = batch.submit(bot.List, "group")
+            buddies = batch.submit(bot.List, "buddy")
+        groups = [group for group in batch.result(groups) or [] if group.qq != '#NULL']
+        buddies = batch.result(buddies) or []
+
+        with self.server.batch() as batch:
+            futures = [(group.qq, batch.submit(bot.List, group)) for group in groups]
+        members = {}
+        for (qq, future) in futures:
+            try:
+                members[qq] = batch.result(future) or []
+            except Exception as e:
+                # one group failing keeps what was known of it
+                members[qq] = self.members.get(qq) or []
+                ERROR("cannot list the members of group %s, keeping %d known: %s" %
+                        (qq, len(members[qq]), e))
+        return (groups, members, buddies)
+
+    # load from QQ now, serving the current entries to everyone meanwhile
+    def refresh(self):
+        with self.lock:
+            if self.loading is not None:
+                return
+            loading = self.loading = threading.Event()
+        try:
+            self.install(*self.load())
+        except Exception:
+            EXCEPTION("contact directory refresh failed, keeping stale entries")
+        finally:
+            with self.lock:
+                self.loading = None
+            loading.set()
+
+    def install(self, groups, members, buddies, live=True):
+        contactByQQ = {}
+        for group in groups:
+            for member in members[group.qq]:
+                contactByQQ[member.qq] = member
+        for buddy in buddies:
+            contactByQQ[buddy.qq] = buddy
+
+        with self.lock:
+            self.groups = groups
+            self.members = members
+            self.memberCounts = dict((qq, len(rows)) for (qq, rows) in members.items())
+            self.buddies = buddies
+            self.groupByQQ = dict((group.qq, group) for group in groups)
+            self.buddyByQQ = dict((buddy.qq, buddy) for buddy in buddies)
+            self.contactByQQ = contactByQQ
+            self.generation += 1
+            self.expires = time.time() + self.ttl
+            self.live = live
+        INFO("contact directory loaded: %d groups, %d buddies, %d contacts" %
+                (len(groups), len(buddies), len(contactByQQ)))
+        if live:
+            self.liveLoaded.set()
+            self.server.directoryLoaded()
+
+    def listGroups(self):
+        self.ensure()
+        return self.groups
+
+    def listBuddies(self):
+        self.ensure()
+        return self.buddies
+
+    def listMembers(self, qq):
+        self.ensure()
+        return self.members.get(qq)
+
+    # the loaded member list of group `qq`, without refreshing anything
+    def peekMembers(self, qq):
+        return self.members.get(qq)
+
+    def memberCount(self, qq):
+        self.ensure()
+        return self.memberCounts.get(qq, 0)
+
+    def listAllMembers(self):
+        self.ensure()
+        (groups, membersByGroup) = (self.groups, self.members)
+        members = []
+        for group in groups:
+            members += membersByGroup.get(group.qq) or []
+        return members
+
+    def group(self, qq):
+        self.ensure()
+        return self.groupByQQ.get(qq)
+
+    def buddy(self, qq):
+        self.ensure()
+        return self.buddyByQQ.get(qq)
+
+    def contact(self, qq):
+        self.ensure()
+        return self.contactByQQ.get(qq)
+
+    # the contact loaded from QQ for `contact`, which may come from the
+    # snapshot; None if QQ does not know it (or did not answer in time)
+    def liveContact(self, contact):
+        if not self.liveLoaded.wait(self.server.fetcher.timeout):
+            return None
+        if contact.ctype == 'group':
+            return self.groupByQQ.get(contact.qq)
+        elif contact.ctype == 'buddy':
+            return self.buddyByQQ.get(contact.qq)
+        return self.contactByQQ.get(contact.qq)
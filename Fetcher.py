@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import time
+from concurrent.futures import Future, TimeoutError
+
+from qqbot.mainloop import Put
+
+from Metrics import Registry
+
+class FetchTimeout(Exception):
+    pass
+
+# Calls submitted to a batch are handed to the qqbot mainloop as a single
+# task when the batch is run, so N lookups cost one round trip.  Every call
+# shares the batch deadline; calls still queued when it passes are skipped.
+class FetchBatch(object):
+    def __init__(self, fetcher, timeout):
+        self.fetcher = fetcher
+        self.deadline = time.time() + timeout
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.run()
+
+    def submit(self, fetcher, *args, **kwargs):
+        future = Future()
+        self.calls.append((future, fetcher, args, kwargs))
+        return future
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        if calls:
+            self.fetcher.put(self.fetcher.run_, calls, time.time(), self.deadline)
+
+    def result(self, future):
+        try:
+            return future.result(max(0, self.deadline - time.time()))
+        except TimeoutError:
+            future.cancel()
+            self.fetcher.timeouts.inc()
+            raise FetchTimeout("timed out waiting for QQ")
+
+class Fetcher(object):
+    # `put` queues a task on the thread that may call into the bot
+    def __init__(self, timeout=30, metrics=None, put=Put):
+        self.timeout = timeout
+        self.put = put
+        self.metrics = metrics if metrics is not None else Registry()
+        self.timeouts = self.metrics.counter('qq_fetch_timeouts_total',
+                'QQ fetches given up on by their caller')
+
+    def histogram(self, name):
+        return self.metrics.histogram('qq_fetch_seconds',
+                'Time from submitting a QQ fetch to its completion on the mainloop',
+                {'call': name})
+
+    def batch(self, timeout=None):
+        return FetchBatch(self, self.timeout if timeout is None else timeout)
+
+    # runs on the qqbot mainloop, or whatever `put` hands tasks to
+    def run_(self, calls, submitted, deadline):
+        for (future, fetcher, args, kwargs) in calls:
+            if not future.set_running_or_notify_cancel():
+                continue
+            if time.time() > deadline:
+                future.set_exception(FetchTimeout("deadline passed before fetch ran"))
+                continue
+            try:
+                future.set_result(fetcher(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            self.histogram(getattr(fetcher, '__name__', 'fetch')).observe(time.time() - submitted)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import inspect
+import re
+
+from qqbot.utf8logger import ERROR
+
+def decodeLine(data):
+    try:
+        return codecs.utf_8_decode(data, 'strict', True)[0]
+    except UnicodeDecodeError:
+        return codecs.utf_8_decode(data, 'replace', True)[0]
+
+# Splits a byte stream into lines inside one reusable buffer.  Lines are
+# decoded straight from memoryview slices of the buffer, so neither the
+# received chunks nor the lines are copied into intermediate bytes.  A line
+# longer than the buffer is dropped whole, up to its line break.
+class LineFramer(object):
+    def __init__(self, size=16384):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.discarding = False
+
+    def reserve_(self):
+        if self.end < len(self.buffer):
+            return True
+        if self.start:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            (self.start, self.end) = (0, pending)
+            return True
+        ERROR("dropping a line longer than %d bytes" % self.end)
+        (self.start, self.end) = (0, 0)
+        self.discarding = True
+        return False
+
+    # returns the complete lines received, or None at end of stream
+    def recvFrom(self, sock):
+        self.reserve_()
+        n = sock.recv_into(self.view[self.end:])
+        if not n:
+            return None
+        self.end += n
+        return self.lines_()
+
+    def feed(self, data):
+        lines = []
+        data = memoryview(data)
+        while data:
+            self.reserve_()
+            n = min(len(data), len(self.buffer) - self.end)
+            self.view[self.end:self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+            lines += self.lines_()
+        return lines
+
+    def lines_(self):
+        lines = []
+        buffer = self.buffer
+        pos = self.start
+        if self.discarding:
+            i = buffer.find(b'\n', pos, self.end)
+            if i < 0:
+                (self.start, self.end) = (0, 0)
+                return lines
+            self.discarding = False
+            pos = i + 1
+        while True:
+            i = buffer.find(b'\n', pos, self.end)
+            if i < 0:
+                break
+            j = i - 1 if i > pos and buffer[i - 1] == 13 else i
+            if j > pos:
+                lines.append(decodeLine(self.view[pos:j]))
+            pos = i + 1
+        if pos == self.end:
+            (self.start, self.end) = (0, 0)
+        else:
+            self.start = pos
+        return lines
+
+# Splits encoded UTF-8 `data` into pieces of at most `budget` bytes, never
+# inside a character and, where one falls in the last quarter of a piece,
+# at a space (which is dropped).
+def splitEncoded(data, budget):
+    if len(data) <= budget:
+        return [data]
+    pieces = []
+    start = 0
+    while len(data) - start > budget:
+        end = start + budget
+        while end > start and ord(data[end:end + 1]) & 0xC0 == 0x80:
+            end -= 1
+        if end == start:
+            end = start + budget
+        space = data.rfind(b' ', end - budget // 4, end)
+        if space > start:
+            pieces.append(data[start:space])
+            start = space + 1
+        else:
+            pieces.append(data[start:end])
+            start = end
+    pieces.append(data[start:])
+    return pieces
+
+class IrcMessage(object):
+    __slots__ = ('tags', 'prefix', 'command', 'params')
+
+    def __init__(self, tags, prefix, command, params):
+        self.tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+
+tagEscapes = { ':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n' }
+tagEscapeRegex = re.compile(r'\\(.?)')
+def unescapeTag(value):
+    return tagEscapeRegex.sub(lambda m: tagEscapes.get(m.group(1), m.group(1)), value)
+
+# [@tags] [:prefix] command params... [:trailing]  (RFC 1459 + IRCv3 tags)
+def parseMessage(line):
+    tags = None
+    prefix = None
+    pos = 0
+    if line.startswith('@'):
+        end = line.find(' ')
+        if end < 0:
+            return None
+        tags = {}
+        for tag in line[1:end].split(';'):
+            if not tag:
+                continue
+            (key, sep, value) = tag.partition('=')
+            tags[key] = unescapeTag(value) if sep else ''
+        pos = end + 1
+    while line.startswith(' ', pos):
+        pos += 1
+    if line.startswith(':', pos):
+        end = line.find(' ', pos)
+        if end < 0:
+            return None
+        prefix = line[pos + 1:end]
+        pos = end + 1
+
+    trailing = line.find(' :', pos)
+    if trailing >= 0:
+        params = line[pos:trailing].split()
+        params.append(line[trailing + 2:])
+    else:
+        params = line[pos:].split()
+    if not params:
+        return None
+    return IrcMessage(tags, prefix, params[0].upper(), params[1:])
+
+# {COMMAND: (handler, minArgs, maxArgs)} for the methods of `cls` whose name
+# matches `pattern`; maxArgs is None when the handler takes *args
+def commandTable(cls, pattern):
+    regex = re.compile(pattern)
+    table = {}
+    for name in dir(cls):
+        match = regex.match(name)
+        if not match:
+            continue
+        handler = getattr(cls, name)
+        handler = getattr(handler, '__func__', handler)
+        code = handler.__code__
+        argCount = code.co_argcount - 1
+        minArgs = argCount - len(handler.__defaults__ or ())
+        maxArgs = None if code.co_flags & inspect.CO_VARARGS else argCount
+        table[match.group(1)] = (handler, minArgs, maxArgs)
+    return table
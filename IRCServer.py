@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import socket
+import sys
 import threading
 import re
 import time
-import fnmatch
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import socketserver
@@ -12,8 +15,20 @@ except ImportError:
 
 from qqbot.utf8logger import DEBUG, ERROR, EXCEPTION, INFO
 from qqbot.mainloop import StartDaemonThread, Put
-from qqbot.common import Queue
-from supybot.ircutils import IrcDict, IrcSet
+from supybot import ircutils
+from supybot.ircutils import IrcSet
+
+from Backlog import Backlog
+from ChannelIndex import ChannelIndex
+from ContactDirectory import ContactDirectory
+from IRCProtocol import LineFramer, commandTable, parseMessage, splitEncoded
+from Transcoder import ircToQQ, qqToIrc
+from Fetcher import Fetcher
+from Ingest import IngestQueue
+from Lanes import CONTROL, INTERACTIVE, Lanes, bulk
+from Metrics import Registry, serveMetrics
+from SendQueue import SendQueue
+from Snapshot import Snapshot, SnapshotContact
 
 class IrcException(Exception):
     pass
@@ -31,6 +46,9 @@ SRV_VERSION = "0.1"
 SRV_WELCOME = "Welcome to %s v%s" % (SRV_NAME, SRV_VERSION)
 
 RPL_WELCOME          = '001'
+RPL_STATSCOMMANDS    = '212'
+RPL_ENDOFSTATS       = '219'
+RPL_STATSDEBUG       = '249'
 ERR_NOSUCHNICK       = '401'
 ERR_NOSUCHCHANNEL    = '403'
 ERR_CANNOTSENDTOCHAN = '404'
@@ -39,12 +57,42 @@ ERR_ERRONEUSNICKNAME = '432'
 ERR_NICKNAMEINUSE    = '433'
 ERR_NEEDMOREPARAMS   = '461'
 
-class UniqNameMap:
-    def __init__(self, client, isChannel):
-        self.client = client
-        self.toQQ = IrcDict()
-        self.toIRC = IrcDict()
+try:
+    intern = sys.intern
+except AttributeError:
+    pass
+
+# dict keyed by case-folded IRC names; only lookups pay for folding
+class IrcNameDict(dict):
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, ircutils.toLower(name))
+
+    def __contains__(self, name):
+        return dict.__contains__(self, ircutils.toLower(name))
+
+    def get(self, name, default=None):
+        return dict.get(self, ircutils.toLower(name), default)
+
+# One map per server shared by all its clients.  toIRC is keyed by qq and
+# never folded; toQQ holds folded names.  Colliding names get the next
+# number from a counter per base name rather than probing from 1 again.
+# Connected clients reserve their nicks in toQQ (for the account's qq), so
+# no contact is given one of them.
+class UniqNameMap(object):
+    __slots__ = ('server', 'isChannel', 'named', 'lock', 'toQQ', 'toIRC', 'nextSuffix', 'reserved')
+
+    def __init__(self, server, isChannel, named=True):
+        self.server = server
         self.isChannel = isChannel
+        self.named = named
+        self.lock = threading.Lock()
+        self.toQQ = IrcNameDict()
+        self.toIRC = {}
+        self.nextSuffix = {}
+        # reservations per folded nick
+        self.reserved = {}
 
     def register(self, nick, qq):
         if qq in self.toIRC:
@@ -52,138 +100,438 @@ class UniqNameMap:
         if qq == '#NULL':
             return False
 
-        if qq == self.client.qq and not self.isChannel:
-            pass
-        elif self.isChannel and not self.client.useNamedChannel:
+        if self.isChannel and not self.named:
             nick = qq
         else:
             if not nick:
                 nick = qq
-            nick = self.client.server.toIrcNick(nick)
+            nick = self.server.toIrcNick(nick)
 
         if self.isChannel:
             nick = '#' + nick
 
-        suffix = ''
-        while nick + str(suffix) in self.toQQ:
-            if not suffix:
-                if nick[-1].isdigit():
-                    nick += '_'
-                suffix = 1
-            else:
-                suffix += 1
-        nick += str(suffix)
-
-        self.toQQ[nick] = qq
-        self.toIRC[qq] = nick
+        with self.lock:
+            if qq in self.toIRC:
+                return True
+
+            folded = ircutils.toLower(nick)
+            if dict.__contains__(self.toQQ, folded):
+                base = nick + '_' if nick[-1].isdigit() else nick
+                folded = ircutils.toLower(base)
+                suffix = self.nextSuffix.get(folded, 1)
+                while dict.__contains__(self.toQQ, folded + str(suffix)):
+                    suffix += 1
+                self.nextSuffix[folded] = suffix + 1
+                nick = base + str(suffix)
+                folded += str(suffix)
+
+            qq = intern(str(qq))
+            dict.__setitem__(self.toQQ, intern(folded), qq)
+            self.toIRC[qq] = intern(nick)
         return True
 
-class IRCClient(socketserver.StreamRequestHandler):
+    # take over names given earlier, {qq: name}
+    def preload(self, names):
+        with self.lock:
+            for (qq, nick) in names.items():
+                folded = ircutils.toLower(nick)
+                if qq in self.toIRC or dict.__contains__(self.toQQ, folded):
+                    continue
+                qq = intern(str(qq))
+                dict.__setitem__(self.toQQ, intern(folded), qq)
+                self.toIRC[qq] = intern(nick)
+
+    def names(self):
+        with self.lock:
+            return dict(self.toIRC)
+
+    # False if `nick` is the name of someone else than `qq`
+    def reserve(self, nick, qq):
+        folded = ircutils.toLower(nick)
+        with self.lock:
+            owner = dict.get(self.toQQ, folded)
+            if owner is not None and owner != qq:
+                return False
+            dict.__setitem__(self.toQQ, intern(folded), intern(str(qq)))
+            self.reserved[folded] = self.reserved.get(folded, 0) + 1
+            return True
+
+    def release(self, nick, qq):
+        folded = ircutils.toLower(nick)
+        with self.lock:
+            count = self.reserved.pop(folded, 0) - 1
+            if count > 0:
+                self.reserved[folded] = count
+            elif ircutils.toLower(self.toIRC.get(qq, '')) != folded and \
+                    dict.get(self.toQQ, folded) == qq:
+                dict.__delitem__(self.toQQ, folded)
+
+# Lines queued by sendLine since the last flush.  Whoever appends to an idle
+# buffer schedules one flush on the sender, which then writes what is
+# pending in a single vectored write.  Chunks wait in Lanes: replies to
+# PING and interactive commands are written before bulk traffic, and one
+# flush takes at most `flushBytes`, so a large dump is written in slices
+# with whatever turns more urgent in between.
+#
+# What the client has not read yet (pending lines, the batch being written
+# and whatever `backlog()` reports the transport still holds) is limited to
+# `maxBytes` bytes, and pending lines to `maxLines`.  Past a limit `policy`
+# decides: 'disconnect' closes the buffer and has append return `overflow`
+# for the client to drop the connection; 'drop' discards new channel
+# traffic (appended with a target) but keeps control replies; 'summarize'
+# also discards the channel traffic already pending, and the client is
+# told per channel how much it missed once the buffer drains.
+#
+# Output of the client's own work (a JOIN # replaying every channel) is not
+# held against it: past half the limits the work waits for the client to
+# read what is buffered, and the other half is left to channel traffic
+# arriving meanwhile.
+class OutputBuffer(object):
+    overflow = 'overflow'
+    policies = ('disconnect', 'drop', 'summarize')
+    flushBytes = 65536
+    flushLane = bulk(None)
+
+    def __init__(self, maxBytes=0, maxLines=0, policy='disconnect'):
+        if policy not in self.policies:
+            raise ValueError("unknown slow client policy %r" % policy)
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)
+        self.progress = 0
+        # items are (data, target)
+        self.pending = Lanes()
+        self.flushScheduled = None
+        self.maxBytes = maxBytes
+        self.maxLines = maxLines
+        self.policy = policy
+        self.backlog = lambda: 0
+        self.pendingBytes = 0
+        self.pendingLines = 0
+        self.writingBytes = 0
+        self.closed = False
+        self.missed = collections.OrderedDict()
+
+        self.dropped = 0
+        self.flushes = 0
+        self.lines = 0
+        self.bytes = 0
+        self.syscalls = 0
+        self.maxFlushLines = 0
+
+    def buffered(self):
+        return self.pendingBytes + self.writingBytes + self.backlog()
+
+    def over_(self, size, lines, share=1):
+        return bool((self.maxBytes and self.buffered() + size > self.maxBytes // share) or
+                    (self.maxLines and self.pendingLines + lines > self.maxLines // share))
+
+    # `data` from the client's own work should wait for the client to read
+    # what is buffered
+    def crowded(self, data):
+        with self.lock:
+            return self.crowded_(len(data), data.count(b'\n'))
+
+    def crowded_(self, size, lines):
+        return not self.closed and self.buffered() > 0 and self.over_(size, lines, 2)
+
+    # False if the client read nothing for `timeout`
+    def waitRoom(self, data, timeout):
+        (size, lines) = (len(data), data.count(b'\n'))
+        with self.lock:
+            while self.crowded_(size, lines):
+                progress = self.progress
+                self.room.wait(timeout)
+                if self.progress == progress:
+                    return False
+            return True
+
+    # `target`: the channel or nick of channel traffic, None for replies,
+    # which go to `lane`.  Returns the lane to queue a flush in, None if
+    # there is none to queue (one is queued already, or `data` was dropped),
+    # or `overflow`.
+    def append(self, data, target=None, lane=INTERACTIVE):
+        lines = data.count(b'\n')
+        with self.lock:
+            if self.closed:
+                return None
+            if self.over_(len(data), lines):
+                if self.policy == 'disconnect':
+                    self.close_()
+                    return self.overflow
+                if target is not None:
+                    if self.policy == 'summarize':
+                        self.discard_(lambda item: item[1] is None)
+                    if self.over_(len(data), lines):
+                        self.miss_(target)
+                        return None
+            if target is not None:
+                lane = bulk(target)
+            self.pending.put(lane, (data, target))
+            self.pendingBytes += len(data)
+            self.pendingLines += lines
+            return self.schedule_(lane)
+
+    # the lane to queue a flush in, None if one is queued that runs as early
+    @staticmethod
+    def rank_(lane):
+        return 0 if lane == CONTROL else 1 if lane == INTERACTIVE else 2
+
+    def schedule_(self, lane):
+        rank = self.rank_(lane)
+        if self.flushScheduled is not None and self.flushScheduled <= rank:
+            return None
+        self.flushScheduled = rank
+        return lane if rank < 2 else self.flushLane
+
+    def miss_(self, target):
+        self.missed[target] = self.missed.get(target, 0) + 1
+        self.dropped += 1
+
+    # drop the pending chunks `keep` refuses, counting channel traffic as
+    # missed
+    def discard_(self, keep):
+        for (data, target) in self.pending.filter(keep):
+            self.pendingBytes -= len(data)
+            self.pendingLines -= data.count(b'\n')
+            if target is not None:
+                self.miss_(target)
+
+    # (chunks to write now, lane to queue the next flush in or None); a chunk
+    # larger than what is left of `flushBytes` is cut after a line and the
+    # rest put back
+    def take(self):
+        chunks = []
+        size = 0
+        with self.lock:
+            while size < self.flushBytes:
+                entry = self.pending.pop()
+                if entry is None:
+                    break
+                (lane, (data, target)) = entry
+                room = self.flushBytes - size
+                if len(data) > room:
+                    cut = data.rfind(b'\n', 0, room) + 1 or data.find(b'\n', room) + 1
+                    if 0 < cut < len(data):
+                        self.pending.putFront(lane, (data[cut:], target))
+                        data = data[:cut]
+                chunks.append(data)
+                size += len(data)
+            lines = sum(chunk.count(b'\n') for chunk in chunks)
+            self.pendingBytes -= size
+            self.pendingLines -= lines
+            self.writingBytes = size
+            self.flushScheduled = None
+            more = self.schedule_(self.flushLane) if len(self.pending) else None
+
+        if chunks:
+            self.flushes += 1
+            self.lines += lines
+            self.bytes += size
+            self.maxFlushLines = max(self.maxFlushLines, lines)
+        return (chunks, more)
+
+    # the client stopped reading: nothing more is buffered; False if the
+    # buffer was closed already
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return False
+            self.close_()
+            return True
+
+    def close_(self):
+        self.closed = True
+        self.discard_(lambda item: False)
+
+    # `data` goes out after the buffer was closed by an overflow
+    def last(self, data):
+        with self.lock:
+            self.pending.put(CONTROL, (data, None))
+            self.pendingBytes += len(data)
+            return self.schedule_(CONTROL)
+
+    # the chunks taken last were handed to the transport
+    def written(self):
+        with self.lock:
+            self.writingBytes = 0
+            self.wake_()
+
+    # the transport wrote out some of its backlog
+    def drained(self):
+        with self.lock:
+            self.wake_()
+
+    def wake_(self):
+        self.progress += 1
+        self.room.notify_all()
+
+    # traffic dropped since the last call, per target, once the buffer has
+    # room again
+    def takeMissed(self):
+        with self.lock:
+            if not self.missed or self.closed or self.over_(0, 0):
+                return None
+            (missed, self.missed) = (self.missed, collections.OrderedDict())
+            return missed
+
+# What a registered client leaves behind when its connection drops, kept
+# until the same nick and password come back
+class DetachedSession(object):
+    __slots__ = ('key', 'channels', 'parted', 'members', 'backlogSeen', 'seq', 'detachedAt')
+
+    def __init__(self, key, channels, parted, members, backlogSeen, seq):
+        self.key = key
+        self.channels = channels
+        self.parted = parted
+        self.members = members
+        self.backlogSeen = backlogSeen
+        self.seq = seq
+        self.detachedAt = time.time()
+
+# NAMES tokens of one channel, encoded once and packed into 353 bodies of a
+# given size on demand.  The client's own entry is kept out because its
+# nick differs between clients.
+class NamesEntry(object):
+    __slots__ = ('members', 'signature', 'nickNames', 'tokens', 'selfMember', 'chunksByBudget')
+
+    def __init__(self, members, signature, nickNames, tokens, selfMember):
+        self.members = members
+        self.signature = signature
+        self.nickNames = nickNames
+        self.tokens = tokens
+        self.selfMember = selfMember
+        self.chunksByBudget = {}
+
+    def chunks(self, budget):
+        chunks = self.chunksByBudget.get(budget)
+        if chunks is not None:
+            return chunks
+
+        chunks = []
+        line = []
+        size = -1
+        for token in self.tokens:
+            if line and size + 1 + len(token) > budget:
+                chunks.append(b' '.join(line))
+                line = []
+                size = -1
+            line.append(token)
+            size += 1 + len(token)
+        if line:
+            chunks.append(b' '.join(line))
+        self.chunksByBudget[budget] = chunks
+        return chunks
+
+# One inbound QQ message, split and encoded once for all clients.  Clients
+# that render it identically (same sender hostmask and target) share the
+# wire bytes.  Rendered lines are cut to fit 512 bytes with their prefix;
+# past `maxLines` of them the rest is collapsed into one NOTICE.
+class QQMessage(object):
+    newLineRegex = re.compile("[\r\n]+")
+    lineLimit = 512
+    minBudget = 64
+
+    # dialog: group or sender buddy
+    # member: member in channel
+    # received: when the poll loop handed the message over
+    def __init__(self, dialog, member, content, maxLines=0, received=None):
+        self.dialog = dialog
+        self.member = member
+        self.sender = member if member is not None else dialog
+        (self.content, self.isAction) = qqToIrc(content)
+        self.lines = [line.encode('utf8') for line in self.newLineRegex.split(self.content)]
+        self.size = sum(len(line) for line in self.lines)
+        self.delivered = time.time()
+        self.time = received if received is not None else self.delivered
+        self.seq = 0
+        self.maxLines = maxLines
+        self.rendered = {}
+
+    # `tags` (IRCv3 message tags) are only used for replays and not cached
+    def render(self, hostmask, target, viaRawChannel, tags=None):
+        key = (hostmask, target, viaRawChannel)
+        encoded = None if tags else self.rendered.get(key)
+        if encoded is None:
+            if viaRawChannel:
+                (channel, lead) = (IRCClientBase.rawChannel, '%s: ' % target)
+            else:
+                (channel, lead) = (target, '')
+            head = ':%s PRIVMSG %s :' % (hostmask, channel)
+            tail = IRCClientBase.crlf
+            lines = self.lines
+            framed = []
+            if self.isAction:
+                # only the first line is the action, the rest follow as text
+                framed = self.frame_((head + '\x01ACTION ' + lead).encode('utf8'),
+                                     lines[:1], b'\x01' + tail)
+                lines = lines[1:]
+            framed += self.frame_((head + lead).encode('utf8'), lines, tail)
+            overflow = b''
+            if self.maxLines and len(framed) > self.maxLines:
+                overflow = ('%s NOTICE %s :[%d more lines not shown]\r\n' %
+                            (_SRV_PREFIX, channel, len(framed) - self.maxLines)).encode('utf8')
+                framed = framed[:self.maxLines]
+            if tags:
+                tagged = ('@%s ' % tags).encode('utf8')
+                framed = [tagged + line for line in framed]
+                overflow = overflow and tagged + overflow
+            encoded = b''.join(framed) + overflow
+            if not tags:
+                self.rendered[key] = encoded
+        return encoded
+
+    # `lines` cut to fit between `head` and `tail`, and put there
+    def frame_(self, head, lines, tail):
+        budget = max(self.minBudget, self.lineLimit - len(head) - len(tail))
+        return [head + piece + tail for line in lines for piece in splitEncoded(line, budget)]
+
+class IRCClientBase(object):
     crlf = "\r\n".encode("utf8")
     rawChannel = '+all+'
+    abortTimeout = 5
+    drainTimeout = 30
 
-    def setup(self):
-        socketserver.StreamRequestHandler.setup(self)
-
+    def setupClient(self):
         self.nick = None
         self.realname = None
+        self.username = None
         self.password = None
         self.me = None
         self.isSupported = IrcSet()
         self.joinedChannels = IrcSet()
+        # qq of the groups the client parted, which JOIN # leaves out
+        self.parted = set()
         self.useNamedChannel = False
-        self.channelNames = UniqNameMap(self, True)
-        self.nickNames    = UniqNameMap(self, False)
+        self.channelNames = self.server.numericChannelNames
+        self.nickNames    = self.server.nickNames
         self.onProtocolDecided = self.onProtocolDecided_
         self.onQQMessage = self.onQQMessage_pending
-        self.qqMessageQueue = []
-
+        self.caps = set()
+        self.capNegotiating = False
+        # backlog position at connect time, and per dialog the newest
+        # message this client has seen, in +all+ or the dialog's own window
+        self.connectSeq = self.server.backlog.seq
+        self.backlogSeen = {}
+        # joined channels still waiting for their NAMES and TOPIC
+        self.unsynced = collections.OrderedDict()
+        self.syncLock = threading.Lock()
+        self.syncRunning = False
+
+        self.reservedNick = None
         self.lineProcessor_ = self.processLine_unregistered
-        self.senderQueue = Queue.Queue()
-
-        self.fetch_cv = threading.Condition()
-        self.fetch_result = None
+        self.running = threading.local()
+        self.output = OutputBuffer(int(self.server.option('IRCClientMaxOutputBytes', 1 << 20)),
+                                   int(self.server.option('IRCClientMaxOutputLines', 10000)),
+                                   self.server.option('IRCSlowClientPolicy', 'disconnect'))
+        self.quitting = False
 
         self.server.addClient(self)
 
-        reader = threading.Thread(target=self.reader)
-        reader.daemon = True
-        reader.start()
-
-    def handle(self):
-        self.sender()
-
-    def finish(self):
-        self.server.removeClient(self)
-        socketserver.StreamRequestHandler.finish(self)
-        INFO("finish()")
-
     def exit(self):
         INFO("exit()")
         self.sender_exit()
         self.reader_exit()
 
-    def fetcher_(self, fetcher, *args, **kwargs):
-        self.fetch_cv.acquire()
-        try:
-            self.fetch_result = (fetcher(*args, **kwargs), None)
-        except Exception as e:
-            self.fetch_result = (None, e)
-        finally:
-            self.fetch_cv.notify()
-            self.fetch_cv.release()
-
-    def fetch(self, fetcher, *args, **kwargs):
-        Put(self.fetcher_, fetcher, *args, **kwargs)
-
-        self.fetch_cv.acquire()
-        self.fetch_cv.wait()
-        (result, exception) = self.fetch_result
-        self.fetch_result = None
-        self.fetch_cv.release()
-
-        if exception:
-            raise exception
-        return result
-
-    def reader(self):
-        try:
-            while self.rfile:
-                line = self.rfile.readline().strip().decode('utf8')
-                if len(line) == 0:
-                    break
-                self.sender_put(self.processLine, line)
-        finally:
-            INFO("reader thread exit")
-            self.sender_exit()
-
-    def reader_exit(self):
-        INFO("reader_exit()")
-
-    # sender
-    def sender(self):
-        try:
-            while True:
-                try:
-                    (f, args, kwargs) = self.senderQueue.get()
-                    f(*args, **kwargs)
-                finally:
-                    self.senderQueue.task_done()
-
-        except SystemExit:
-            pass
-        finally:
-            INFO("sender thread exit")
-            self.reader_exit()
-
-    def sender_put(self, f, *args, **kwargs):
-        self.senderQueue.put((f, args, kwargs))
-
-    def sender_exit(self):
-        def exit():
-            raise SystemExit()
-        self.sender_put(exit)
-
     def ircmsg(self, *args):
         args = list(args)
         if args[0]:
@@ -195,24 +543,139 @@ class IRCClient(socketserver.StreamRequestHandler):
         self.sendLine(' '.join(args))
 
     def sendLine(self, line):
-        def sendLine(line):
-            encoded = line.encode('utf8') if not isinstance(line, bytes) else line
-            self.request.sendall(encoded)
-            self.request.sendall(self.crlf)
-        self.sender_put(sendLine, line)
+        if isinstance(line, bytes):
+            self.sendEncoded(line + self.crlf)
+        else:
+            self.sendEncoded((line + "\r\n").encode('utf8'))
 
-    def processLine(self, line):
-        if ' :' in line:
-            (args, last) = line.split(' :', 1)
-            args = args.split(' ')
-            args.append(last)
+    # `encoded` is one or more complete lines, CRLFs included; `target` marks
+    # channel traffic, which a slow client may lose
+    def sendEncoded(self, encoded, target=None):
+        if not self.makeRoom_(encoded):
+            return
+        result = self.output.append(encoded, target, self.runningLane())
+        if result is OutputBuffer.overflow:
+            self.slowConsumer_()
+        elif result is not None:
+            self.sender_putIn(result, self.flush)
+
+    def flush(self):
+        (chunks, more) = self.output.take()
+        if chunks:
+            try:
+                self.writeChunks(chunks)
+            finally:
+                self.output.written()
+        if more is not None:
+            self.sender_putIn(more, self.flush)
+        missed = self.output.takeMissed()
+        if missed:
+            self.reportMissed_(missed)
+
+    # the running work waits for the client to read what is buffered rather
+    # than have its own output counted against it; False if the client is
+    # not reading
+    def makeRoom_(self, encoded):
+        if not getattr(self.running, 'mayWait', False) or not self.output.crowded(encoded):
+            return True
+        if self.drain_(encoded):
+            return True
+        if self.output.close():
+            self.slowConsumer_()
+        return False
+
+    # `f` runs with live delivery to every client held up, so what it sends
+    # does not wait for this client; room is made before
+    def underFanout_(self, f, *args):
+        self.makeRoom_(b'')
+        mayWait = getattr(self.running, 'mayWait', False)
+        self.running.mayWait = False
+        try:
+            with self.server.fanoutLock:
+                return f(*args)
+        finally:
+            self.running.mayWait = mayWait
+
+    # the sender may be stuck writing to a client that stopped reading, so
+    # the connection is aborted from a timer if the ERROR does not get through
+    def slowConsumer_(self):
+        INFO("%s is not reading, closing its connection" % self.nick)
+        error = 'ERROR :Closing Link: %s (SendQ exceeded)\r\n' % self.client_address[0]
+        lane = self.output.last(error.encode('utf8'))
+        if lane is not None:
+            self.sender_putIn(lane, self.flush)
+        self.sender_putIn(CONTROL, self.exit)
+        timer = threading.Timer(self.abortTimeout, self.abortConnection)
+        timer.daemon = True
+        timer.start()
+
+    def reportMissed_(self, missed):
+        if self.output.policy == 'summarize':
+            for (target, count) in missed.items():
+                self.ircmsg(None, 'NOTICE', target,
+                            '[%d messages not shown, the connection was too slow]' % count)
         else:
-            args = line.split(' ')
+            self.ircmsg(None, 'NOTICE', self.nick or '*',
+                        '[%d messages dropped, the connection was too slow]' % sum(missed.values()))
 
+    # replies go out in the lane of the work that produced them
+    def runningLane(self):
+        return getattr(self.running, 'lane', INTERACTIVE)
+
+    def runTask_(self, lane, f, args, kwargs):
+        self.running.lane = lane
+        self.running.mayWait = True
         try:
-            self.lineProcessor_(*args)
+            f(*args, **kwargs)
+        finally:
+            self.running.lane = INTERACTIVE
+            self.running.mayWait = False
+
+    def sender_put(self, f, *args, **kwargs):
+        self.sender_putIn(INTERACTIVE, f, *args, **kwargs)
+
+    # output of whatever `f` sends goes out in `lane`
+    def inLane_(self, lane, f, *args):
+        previous = self.runningLane()
+        self.running.lane = lane
+        try:
+            return f(*args)
+        finally:
+            self.running.lane = previous
+
+    # PING, PONG, CAP and registration come first; commands answered with
+    # long dumps are bulk, a lane per command and target, and so are JOIN
+    # and PART, sharing one lane to stay in order
+    controlCommands = frozenset(['PING', 'PONG', 'CAP', 'PASS', 'NICK', 'USER'])
+    bulkCommands = frozenset(['WHO', 'NAMES', 'LIST', 'STATS'])
+    membershipCommands = frozenset(['JOIN', 'PART'])
+    def laneOf_(self, message):
+        command = message.command
+        if command in self.controlCommands:
+            return CONTROL
+        if command in self.membershipCommands:
+            return bulk('membership')
+        if command in self.bulkCommands:
+            return bulk((command,) + tuple(message.params[:1]))
+        return INTERACTIVE
+
+    # queue line `line` read from the client
+    def received_(self, line):
+        message = parseMessage(line)
+        if message is not None:
+            self.sender_putIn(self.laneOf_(message), self.processMessage, message, line)
+
+    def processLine(self, line):
+        message = parseMessage(line)
+        if message is not None:
+            self.processMessage(message, line)
+
+    def processMessage(self, message, line):
+        try:
+            self.lineProcessor_(message.command, message.params)
         except IrcQuit as e:
             INFO("Client quiting %s" % e)
+            self.quitting = True
             self.sendLine("ERROR :Closing Link: %s (Client Quit)\r\n" % str(self.client_address))
             self.exit()
         except IrcError as e:
@@ -220,51 +683,94 @@ class IRCClient(socketserver.StreamRequestHandler):
             self.sendLine("ERROR :%s\r\n" % e)
             self.exit()
         except Exception as e:
-            EXCEPTION("failed to handle: %s" % ' '.join(args))
+            EXCEPTION("failed to handle: %s" % line)
             self.sendLine("ERROR :%s\r\n" % e)
 
-    def processLine_unregistered(self, command, *args):
-        handler = getattr(self, 'do%s_' % command.upper(), None)
-        if not handler:
+    # per class: {'unregistered': table of doXXX_, 'registered': table of doXXX}
+    commandTables_ = {}
+    def commandTable_(self, state):
+        tables = self.commandTables_.get(type(self))
+        if tables is None:
+            tables = {
+                'unregistered': commandTable(type(self), r'^do([A-Z]+)_$'),
+                'registered': commandTable(type(self), r'^do([A-Z]+)$'),
+            }
+            self.commandTables_[type(self)] = tables
+        return tables[state]
+
+    def dispatch_(self, entry, command, args, target):
+        (handler, minArgs, maxArgs) = entry
+        if len(args) < minArgs:
+            self.ircmsg(None, ERR_NEEDMOREPARAMS, target, command, "Not enough parameters")
+            return
+        if maxArgs is not None:
+            args = args[:maxArgs]
+        self.server.metrics.counter('irc_commands_total', 'IRC commands handled',
+                                    {'command': command}).inc()
+        handler(self, *args)
+
+    def processLine_unregistered(self, command, args):
+        entry = self.commandTable_('unregistered').get(command)
+        if not entry:
             ERROR("unknown command: %s %s" % (command, ' '.join(args)))
             return
-        try:
-            handler(*args)
-        except IrcException:
-            raise
-        except TypeError as e:
-            EXCEPTION(e)
-            self.ircmsg(None, ERR_NEEDMOREPARAMS, '*', command, "Not enough parameters" + str(e))
-
-    def processLine_registered(self, command, *args):
-        handler = getattr(self, 'do' + command.upper(), None)
-        if not handler:
+        self.dispatch_(entry, command, args, '*')
+
+    def processLine_registered(self, command, args):
+        entry = self.commandTable_('registered').get(command)
+        if not entry:
             self.ircmsg(None, ERR_UNKNOWNCOMMAND, self.nick, command, "Unknown command")
             return
-
-        try:
-            handler(*args)
-        except IrcException:
-            raise
-        except TypeError as e:
-            EXCEPTION(e)
-            self.ircmsg(None, ERR_NEEDMOREPARAMS, self.nick, command, "Not enough parameters")
+        self.dispatch_(entry, command, args, self.nick)
 
     def doPASS_(self, password):
         self.password = password
 
     def doNICK_(self, nick):
         self.nick = nick
-        if self.realname is not None:
+        if self.realname is not None and not self.capNegotiating:
             self.register()
 
     def doUSER_(self, email, mode, unused, realname):
         # ignore args unless QQ api allow setting these values
+        self.username = email
         self.realname = realname
-        self.qq = self.server.bot.conf.qq
-        if self.nick is not None:
+        if self.nick is not None and not self.capNegotiating:
             self.register()
 
+    def doCAP_(self, subcommand, *args):
+        self.cap_(subcommand.upper(), args)
+
+    def doCAP(self, subcommand, *args):
+        self.cap_(subcommand.upper(), args)
+
+    supportedCaps = ('batch', 'echo-message', 'server-time')
+    def cap_(self, subcommand, args):
+        nick = self.nick or '*'
+        registered = self.lineProcessor_ == self.processLine_registered
+        if subcommand == 'LS':
+            self.capNegotiating = not registered
+            self.ircmsg(None, 'CAP', nick, 'LS', ' '.join(self.supportedCaps))
+        elif subcommand == 'LIST':
+            self.ircmsg(None, 'CAP', nick, 'LIST', ' '.join(sorted(self.caps)))
+        elif subcommand == 'REQ':
+            requested = args[-1].split() if args else []
+            if all(cap.lstrip('-') in self.supportedCaps for cap in requested):
+                for cap in requested:
+                    if cap.startswith('-'):
+                        self.caps.discard(cap[1:])
+                    else:
+                        self.caps.add(cap)
+                self.ircmsg(None, 'CAP', nick, 'ACK', ' '.join(requested))
+            else:
+                self.ircmsg(None, 'CAP', nick, 'NAK', ' '.join(requested))
+        elif subcommand == 'END':
+            self.capNegotiating = False
+            if not registered and self.nick is not None and self.realname is not None:
+                self.register()
+        else:
+            self.ircmsg(None, '410', nick, subcommand, 'Invalid CAP command')
+
     def doQUIT_(self, *args):
         raise IrcQuit(*args)
 
@@ -277,6 +783,16 @@ class IRCClient(socketserver.StreamRequestHandler):
     def register(self):
         if self.password is None:
             raise IrcError("Password invalidate")
+        server = self.server.route(self)
+        if server is None:
+            raise IrcError("Password invalidate")
+        if server is not self.server:
+            self.rebind_(server)
+        self.qq = self.server.bot.conf.qq
+        if not self.reserveNick_(self.nick):
+            self.ircmsg(None, ERR_NICKNAMEINUSE, '*', self.nick, 'Nickname is already in use')
+            self.nick = None
+            return
         self.lineProcessor_ = self.processLine_registered
         self.me = self.server.buildHostmask(self.nick, self.qq)
         self.ircmsg(None, RPL_WELCOME, self.nick, SRV_WELCOME)
@@ -288,10 +804,40 @@ class IRCClient(socketserver.StreamRequestHandler):
                 "CHARSET=UTF-8",
                 "NAMESX",
                 "NAMEDCHANNEL",
+                "WHOX",
                 "are supported by this server")
         self.ircmsg(None, '376', self.nick, 'End of MOTD command.')
 
+    # move to the QQ account `server` chose at registration
+    def rebind_(self, server):
+        self.server.removeClient(self)
+        self.server = server
+        if self.useNamedChannel:
+            self.channelNames = server.channelNames
+        else:
+            self.channelNames = server.numericChannelNames
+        self.nickNames = server.nickNames
+        self.connectSeq = server.backlog.seq
+        server.addClient(self)
+
+    # keep other contacts from being given `nick`, and release the nick
+    # reserved before; False if a contact has it already
+    def reserveNick_(self, nick):
+        if not self.nickNames.reserve(nick, self.qq):
+            return False
+        self.releaseNick_()
+        self.reservedNick = nick
+        return True
+
+    def releaseNick_(self):
+        if self.reservedNick is not None:
+            self.nickNames.release(self.reservedNick, self.qq)
+            self.reservedNick = None
+
     def doNICK(self, nick):
+        if not self.reserveNick_(nick):
+            self.ircmsg(None, ERR_NICKNAMEINUSE, self.nick, nick, 'Nickname is already in use')
+            return
         oldme = self.me
         self.nick = nick
         self.me = self.server.buildHostmask(self.nick, self.qq)
@@ -310,62 +856,198 @@ class IRCClient(socketserver.StreamRequestHandler):
         for proto in protos:
             self.isSupported.add(proto)
         self.useNamedChannel = "NAMEDCHANNEL" in self.isSupported
+        if self.useNamedChannel:
+            self.channelNames = self.server.channelNames
+        else:
+            self.channelNames = self.server.numericChannelNames
 
     def onProtocolDecided_(self):
         self.onProtocolDecided = None
-        self.nickNames.register(self.nick, self.qq)
+        session = self.server.takeSession(self.nick, self.password)
+        if session is not None:
+            self.connectSeq = session.seq
+            self.backlogSeen = dict(session.backlogSeen)
+            self.parted = set(session.parted)
         self.join([self.rawChannel])
-        for (args, kwargs) in self.qqMessageQueue:
-            self.onQQMessage_real(*args, **kwargs)
-        self.qqMessageQueue = None
+        if session is not None:
+            self.reattach_(session)
+        self.underFanout_(self.catchUp_)
+
+    # buddy history, group messages that arrived during registration (or
+    # since the session detached), then live delivery
+    def catchUp_(self):
+        buddies = []
+        for message in self.server.backlog.sinceAll(0):
+            if message.member is None and message.dialog.qq not in buddies:
+                buddies.append(message.dialog.qq)
+        for qq in buddies:
+            self.inLane_(bulk(self.nick), self.replay_, qq, self.me)
+        for message in self.server.backlog.sinceAll(self.connectSeq):
+            if message.member is not None and message.seq > self.backlogSeen.get(message.dialog.qq, 0):
+                self.onQQMessage_real(message)
         self.onQQMessage = self.onQQMessage_real
 
-    def registerNames_(self, names, rows):
-        for row in rows:
-            names.register(row.name, row.qq)
-
-    def registerChannelNames_(self):
-        self.registerNames_(self.channelNames, self.fetch(lambda: self.server.bot.List("group")))
-        def allGroupMembers():
-            members = []
-            for group in self.server.bot.List("group"):
-                members += self.server.bot.List(group)
-            return members
-        self.registerNames_(self.nickNames, self.fetch(allGroupMembers))
-
-    def registerNickNames_(self):
-        self.registerNames_(self.nickNames, self.fetch(lambda: self.server.bot.List("buddy")))
+    # state to keep on the server once the connection is gone, None if
+    # there is nothing to come back to
+    def detach_(self):
+        if self.quitting or self.onProtocolDecided is not None or self.nick is None:
+            return None
+        directory = self.server.directory
+        channels = []
+        members = {}
+        for channel in list(self.joinedChannels):
+            try:
+                qq = self.channelNames.toQQ[channel]
+            except KeyError:
+                continue
+            channels.append(qq)
+            rows = directory.peekMembers(qq)
+            if rows is not None:
+                members[qq] = frozenset(member.qq for member in rows)
+        return DetachedSession((ircutils.toLower(self.nick), self.password), channels,
+                               frozenset(self.parted), members, dict(self.backlogSeen),
+                               self.server.backlog.seq)
+
+    # rejoin the channels of `session`; replay_ then only sends what was
+    # missed, since backlogSeen came back with the session.  NAMES and TOPIC
+    # follow as for any JOIN, and what changed in the member lists while
+    # the client was away is summed up in a NOTICE.
+    def reattach_(self, session):
+        self.server.registerNames()
+        directory = self.server.directory
+        groups = [group for group in map(directory.group, session.channels) if group]
+        missed = len(self.server.backlog.sinceAll(session.seq))
+        self.ircmsg(None, 'NOTICE', self.nick,
+                'Reattached to the session detached at %s: %d channels, %d messages since' %
+                (time.strftime('%H:%M:%S', time.localtime(session.detachedAt)), len(groups), missed))
+        self.joinGroups_(groups)
 
+        for group in groups:
+            before = session.members.get(group.qq)
+            rows = directory.peekMembers(group.qq)
+            if before is None or rows is None:
+                continue
+            now = frozenset(member.qq for member in rows)
+            if now == before:
+                continue
+            changes = ['+' + self.ircNick_(qq) for qq in now - before if qq in self.nickNames.toIRC]
+            changes += ['-' + self.ircNick_(qq) for qq in before - now if qq in self.nickNames.toIRC]
+            changes = changes[:20]
+            more = len(now ^ before) - len(changes)
+            channel = self.channelNames.toIRC[group.qq]
+            self.inLane_(bulk(channel), self.ircmsg, None, 'NOTICE', channel,
+                    'Members while you were away: ' + ' '.join(changes) +
+                    (' and %d more' % more if more else ''))
+
+    # the client's own qq always maps to its current nick
+    def ircNick_(self, qq):
+        if qq == self.qq:
+            return self.nick
+        return self.nickNames.toIRC[qq]
+
+    def qqOfNick_(self, nick):
+        if ircutils.strEqual(nick, self.nick):
+            return self.qq
+        return self.nickNames.toQQ[nick]
+
+    # NAMES and TOPIC follow each JOIN in 'eager' IRCJoinSync mode; in
+    # 'background' mode they are sent from the server's sync pool, and in
+    # 'ondemand' mode only when the client asks for them
     def joinGroups_(self, groups):
+        eager = self.server.joinSync == 'eager'
+        deferred = []
         for group in groups:
             if not group or group.qq == '#NULL':
                 continue
+            self.parted.discard(group.qq)
             channel = self.channelNames.toIRC[group.qq]
-            self.ircmsg(self.me, 'JOIN', channel)
-            self.doNAMES(channel)
-            self.doTOPIC(channel)
-            self.joinedChannels.add(channel)
+            if channel in self.joinedChannels:
+                continue
+            self.inLane_(bulk(channel), self.joinGroup_, group, channel, eager)
+            if not eager:
+                deferred.append(channel)
+        if deferred:
+            self.deferSync_(deferred)
+
+    # in the lane of the channel's live traffic, which so comes after the
+    # JOIN and the replay
+    def joinGroup_(self, group, channel, eager):
+        self.ircmsg(self.me, 'JOIN', channel)
+        if eager:
+            self.syncChannel_(channel)
+        self.underFanout_(self.joined_, group.qq, channel)
+
+    def joined_(self, qq, channel):
+        self.joinedChannels.add(channel)
+        self.replay_(qq, channel)
+
+    def syncChannel_(self, channel):
+        self.doNAMES(channel)
+        self.doTOPIC(channel)
+
+    def deferSync_(self, channels):
+        with self.syncLock:
+            for channel in channels:
+                self.unsynced[channel] = True
+            if self.server.joinSync != 'background' or self.syncRunning:
+                return
+            self.syncRunning = True
+        self.server.syncPool.submit(self.runTask_, bulk('sync'), self.syncPending_, (), {})
+
+    # one pool worker per client at most, so a client in hundreds of
+    # groups cannot hold up the others
+    def syncPending_(self):
+        while True:
+            with self.syncLock:
+                if not self.unsynced or self not in self.server.clients:
+                    self.syncRunning = False
+                    return
+                (channel, _) = self.unsynced.popitem(last=False)
+            if channel not in self.joinedChannels:
+                continue
+            try:
+                self.syncChannel_(channel)
+            except Exception:
+                EXCEPTION("failed to sync %s" % channel)
+
+    replayBatchId = 0
+    # send the backlog of dialog `qq` this client has not seen in `target`
+    def replay_(self, qq, target):
+        messages = self.server.backlog.since(qq, self.backlogSeen.get(qq, 0))
+        if not messages:
+            return
+        self.backlogSeen[qq] = messages[-1].seq
+
+        batch = None
+        if 'batch' in self.caps:
+            IRCClientBase.replayBatchId += 1
+            batch = 'history%d' % IRCClientBase.replayBatchId
+            self.ircmsg(None, 'BATCH', '+' + batch, 'chathistory', target)
+        for message in messages:
+            tags = []
+            if batch:
+                tags.append('batch=' + batch)
+            if 'server-time' in self.caps:
+                tags.append('time=' + time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(message.time))
+                        + '.%03dZ' % (message.time * 1000 % 1000))
+            self.sendEncoded(message.render(self.messageHostmask_(message), target, False, ';'.join(tags)))
+        if batch:
+            self.ircmsg(None, 'BATCH', '-' + batch)
 
     def findBuddyByNick_(self, nick):
-        qq = self.nickNames.toQQ[nick]
-        buddy = self.server.bot.List("buddy", qq)
-        if len(buddy) != 1 or buddy[0].qq == '#NULL':
-            return
-        return buddy[0]
+        qq = self.qqOfNick_(nick)
+        return self.server.directory.buddy(qq)
 
     def findGroupByChannel_(self, channel):
         if not channel or not channel.startswith('#'):
             return
         qq = self.channelNames.toQQ[channel]
-        group = self.server.bot.List("group", qq)
-        if len(group) != 1 or group[0].qq == '#NULL':
-            return
-        return group[0]
+        return self.server.directory.group(qq)
 
     def findMembersByChannel_(self, channel):
         group = self.findGroupByChannel_(channel)
         if group:
-            return self.server.bot.List(group)
+            return self.server.directory.listMembers(group.qq)
 
     def join(self, channels):
         if '#' in channels:
@@ -374,29 +1056,32 @@ class IRCClient(socketserver.StreamRequestHandler):
             if not channels:
                 return
 
-        self.registerChannelNames_()
+        self.server.registerNames()
 
         if self.rawChannel in channels:
             channels.remove(self.rawChannel)
-            self.registerNickNames_()
-            self.ircmsg(self.me, 'JOIN', self.rawChannel)
-            self.doNAMES(self.rawChannel)
-            self.doTOPIC(self.rawChannel)
+            self.inLane_(bulk(self.rawChannel), self.joinRawChannel_)
 
-        validGroups = self.fetch(lambda: {
+        validGroups = {
             channel:
                 self.findGroupByChannel_(channel)
                     for channel in channels
                         if channel in self.channelNames.toQQ
-        })
+        }
         for channel in channels:
             if channel not in validGroups:
                 self.ircmsg(None, '403', self.nick, channel, 'No such channel')
         self.joinGroups_(validGroups.values())
 
+    def joinRawChannel_(self):
+        self.ircmsg(self.me, 'JOIN', self.rawChannel)
+        self.doNAMES(self.rawChannel)
+        self.doTOPIC(self.rawChannel)
+
     def joinAll(self):
-        self.registerChannelNames_()
-        self.joinGroups_(self.fetch(lambda: self.server.bot.List("group")))
+        self.server.registerNames()
+        self.joinGroups_([group for group in self.server.directory.listGroups()
+                          if group.qq not in self.parted])
 
     def doJOIN(self, channels, key=None):
         if self.onProtocolDecided:
@@ -415,28 +1100,16 @@ class IRCClient(socketserver.StreamRequestHandler):
                 self.joinedChannels.remove(channel)
             except KeyError:
                 self.ircmsg(None, '442', self.nick, channel, "You're not on that channel")
-
-    def doLIST(self, mask='*'):
-        groups = self.fetch(lambda: self.server.bot.List("group"))
-        listGroups = []
-        for group in groups:
-            if group.qq == '#NULL':
                 continue
-            channel = self.channelNames.toIRC[group.qq]
-            if fnmatch.fnmatch(channel, mask):
-                listGroups.append(group)
-
-        memberCounts = self.fetch(lambda: {
-            group.qq:
-                len(self.server.bot.List(group))
-                    for group in listGroups
-        })
+            qq = self.channelNames.toQQ.get(channel)
+            if qq is not None:
+                self.parted.add(qq)
 
+    def doLIST(self, mask='*'):
+        index = self.server.channelIndex(self.channelNames)
         self.ircmsg(None, '321', self.nick, 'Channel', 'Users  Name')
-        for group in listGroups:
-            channel = self.channelNames.toIRC[group.qq]
-            topic = group.nick + ' | ' + group.mark + ' | '+ group.gcode
-            self.ircmsg(None, '322', self.nick, channel, str(memberCounts[group.qq]), topic)
+        for entry in index.match(mask):
+            self.ircmsg(None, '322', self.nick, entry.channel, entry.users, entry.topic)
         self.ircmsg(None, '323', self.nick, 'End of /LIST')
 
     def doTOPIC(self, channel, topic=None):
@@ -444,7 +1117,7 @@ class IRCClient(socketserver.StreamRequestHandler):
             self.ircmsg(None, '332', self.nick, channel, '')
             self.ircmsg(None, '333', self.nick, channel, SRV_PREFIX, str(int(time.time())))
             return
-        group = self.fetch(lambda: self.findGroupByChannel_(channel))
+        group = self.findGroupByChannel_(channel)
         if group:
             topic = group.nick + ' | ' + group.mark + ' | '+ group.gcode
             self.ircmsg(None, '332', self.nick, channel, topic)
@@ -452,73 +1125,145 @@ class IRCClient(socketserver.StreamRequestHandler):
         else:
             self.ircmsg(None, '403', self.nick, channel, 'No such channel')
 
+    def namesEntry_(self, key, members, isChannel, namesx):
+        cacheKey = (key, namesx, self.qq)
+        entry = self.server.namesCache.get(cacheKey)
+        if entry and entry.nickNames is self.nickNames:
+            if entry.members is members:
+                return entry
+            # a directory refresh hands out new lists, often with the same people
+            signature = tuple((member.qq, getattr(member, 'role_id', None)) for member in members)
+            if entry.signature == signature:
+                entry.members = members
+                return entry
+        else:
+            signature = tuple((member.qq, getattr(member, 'role_id', None)) for member in members)
+
+        tokens = []
+        selfMember = None
+        for member in members:
+            if member.qq == '#NULL':
+                continue
+            if member.qq == self.qq:
+                selfMember = member
+                continue
+            tokens.append(self.namesToken_(member, isChannel, namesx))
+        entry = NamesEntry(members, signature, self.nickNames, tokens, selfMember)
+        self.server.namesCache[cacheKey] = entry
+        return entry
+
+    def namesToken_(self, member, isChannel, namesx):
+        token = self.server.roleToPrefix[member.role_id] if isChannel else ''
+        nick = self.ircNick_(member.qq)
+        if namesx:
+            token += self.server.buildHostmask(nick, member.qq)
+        else:
+            token += nick
+        return token.encode('utf8')
+
     def doNAMES(self, channel):
         prefix = (':%s 353 %s @ %s :' % (SRV_PREFIX, self.nick, channel)).encode('utf8')
-        namesBuffer = prefix
+        budget = 499 - len(prefix)
 
         namesx = "NAMESX" in self.isSupported
         if channel == self.rawChannel:
-            members = self.fetch(lambda: self.server.bot.List("buddy")) or []
+            entry = self.namesEntry_(self.rawChannel, self.server.directory.listBuddies(), False, namesx)
             class MySelf(object):
                 qq = self.qq
-            members.append(MySelf())
+            selfMember = MySelf()
             isChannel = False
         else:
-            members = self.fetch(lambda: self.findMembersByChannel_(channel)) or []
+            group = self.findGroupByChannel_(channel)
+            members = group and self.server.directory.listMembers(group.qq) or []
+            entry = self.namesEntry_(group and group.qq, members, True, namesx)
+            selfMember = entry.selfMember
             isChannel = True
 
-        for member in members:
-            if member.qq == '#NULL':
-                continue
-
-            hostmask = self.server.roleToPrefix[member.role_id] if isChannel else ''
-            nick = self.nickNames.toIRC[member.qq]
-            if namesx:
-                hostmask += self.server.buildHostmask(nick, member.qq)
+        chunks = entry.chunks(budget)
+        if selfMember:
+            chunks = list(chunks)
+            token = self.namesToken_(selfMember, isChannel, namesx)
+            if chunks and len(chunks[-1]) + 1 + len(token) <= budget:
+                chunks[-1] += b' ' + token
             else:
-                hostmask += nick
-            hostmask = hostmask.encode('utf8')
-
-            if len(namesBuffer) + len(hostmask) + 1 >= 500:
-                self.sendLine(namesBuffer)
-                namesBuffer = prefix
-            if len(namesBuffer) > len(prefix):
-                namesBuffer += b' '
-            namesBuffer += hostmask
-
-        if len(namesBuffer) >= len(prefix):
-            self.sendLine(namesBuffer)
-
-        self.ircmsg(None, '366', self.nick, channel, 'End of /NAMES list.')
-
-    def doWHO(self, target):
-        if target.lower() == self.nick.lower():
-            self.ircmsg(None, '352', self.nick, '*',
-                    self.qq, 'qq.com', SRV_PREFIX, self.nick,
-                    'HrB', '%d %s' % (0, self.realname))
+                chunks.append(token)
+
+        with self.syncLock:
+            self.unsynced.pop(channel, None)
+        end = '%s 366 %s %s :End of /NAMES list.\r\n' % (_SRV_PREFIX, self.nick, channel)
+        self.sendEncoded(b''.join(prefix + chunk + self.crlf for chunk in chunks or [b''])
+                         + end.encode('utf8'))
+
+    # WHO <target> [%<fields>[,<token>]]: 352 replies, or 354 (WHOX) with
+    # only the requested fields; every reply goes out as one block
+    whoxFields = 'tcuihsnfdlaor'
+    def doWHO(self, target, options=None):
+        (fields, token) = (None, None)
+        if options and options.startswith('%'):
+            (spec, _, token) = options[1:].partition(',')
+            fields = ''.join(field for field in self.whoxFields if field in spec)
+            token = token or '0'
+
+        if ircutils.strEqual(target, self.nick):
+            block = self.whoLine_(fields, token, '*', self.qq, self.nick, 'HrB', self.realname)
         elif target.startswith('#'):
-            channel = target
-            for member in self.fetch(lambda: self.findMembersByChannel_(channel)) or []:
-                self.ircmsg(None, '352', self.nick, channel,
-                        member.qq, 'qq.com', SRV_PREFIX, self.nickNames.toIRC[self.qq],
-                        'Hr' + self.server.roleToPrefix[member.role_id], '0 .')
+            members = self.findMembersByChannel_(target) or []
+            prefixes = self.server.roleToPrefix
+            block = self.whoBlock_((target, fields, token), members,
+                        lambda member: self.whoLine_(fields, token, target, member.qq,
+                            self.ircNick_(member.qq), 'Hr' + prefixes[member.role_id], '.'))
         elif target.startswith('+'):
-            channel = target
-            self.ircmsg(None, '352', self.nick, channel,
-                    self.qq, 'qq.com', SRV_PREFIX, self.nick,
-                    'Hr', '0 .')
-            for member in self.fetch(lambda: self.server.bot.List("buddy")) or []:
-                self.ircmsg(None, '352', self.nick, channel,
-                        member.qq, 'qq.com', SRV_PREFIX, self.nickNames.toIRC[member.qq],
-                        'Hr', '0 .')
+            block = self.whoLine_(fields, token, target, self.qq, self.nick, 'Hr', '.')
+            block += self.whoBlock_((target, fields, token), self.server.directory.listBuddies(),
+                        lambda member: self.whoLine_(fields, token, target, member.qq,
+                            self.ircNick_(member.qq), 'Hr', '.'))
+        else:
+            block = b''
+        if block:
+            self.sendEncoded(block)
         self.ircmsg(None, '315', self.nick, target, 'End of /WHO list.')
 
+    # the replies for `members`, reused until the member list is reloaded
+    def whoBlock_(self, key, members, whoLine):
+        key += (self.nick,)
+        cache = self.server.whoCache
+        entry = cache.get(key)
+        if entry is None or entry[0] is not members:
+            entry = (members, b''.join(whoLine(member) for member in members
+                                                     if member.qq != '#NULL'))
+            if len(cache) >= 256:
+                cache.clear()
+            cache[key] = entry
+        return entry[1]
+
+    def whoLine_(self, fields, token, channel, qq, nick, flags, realname):
+        if fields is None:
+            line = '%s 352 %s %s %s qq.com %s %s %s :0 %s\r\n' % (
+                    _SRV_PREFIX, self.nick, channel, qq, SRV_PREFIX, nick, flags, realname)
+            return line.encode('utf8')
+        values = {
+            't': token, 'c': channel, 'u': qq, 'i': '255.255.255.255', 'h': 'qq.com',
+            's': SRV_PREFIX, 'n': nick, 'f': flags, 'd': '0', 'l': '0', 'a': qq,
+            'o': 'n/a', 'r': ':' + realname,
+        }
+        line = '%s 354 %s %s\r\n' % (_SRV_PREFIX, self.nick,
+                                      ' '.join(values[field] for field in fields))
+        return line.encode('utf8')
+
+    # STATS m: commands handled; any other query dumps every metric
+    def doSTATS(self, query='*'):
+        if query.lower() == 'm':
+            for (labels, counter) in self.server.metrics.family('irc_commands_total'):
+                self.ircmsg(None, RPL_STATSCOMMANDS, self.nick, labels['command'], str(counter.value))
+        else:
+            for line in self.server.metrics.render():
+                if not line.startswith('#'):
+                    self.ircmsg(None, RPL_STATSDEBUG, self.nick, line)
+        self.ircmsg(None, RPL_ENDOFSTATS, self.nick, query, 'End of /STATS report')
+
     def doUSERHOST(self, *args):
         for nick in args:
-            if nick.lower() == self.nick.lower():
-                qq = self.qq
-            else:
-                qq = self.nickNames.toQQ[nick]
+            qq = self.qqOfNick_(nick)
             self.ircmsg(None, '302', self.nick, self.server.buildHostmask(nick, qq).replace('!', '=', 1))
 
     def doQUIT(self, *args):
@@ -531,6 +1276,7 @@ class IRCClient(socketserver.StreamRequestHandler):
         return self.message(True, targets, content)
 
     def message(self, isNotice, targets, content):
+        original = content
         if content.startswith("\x01") and content.endswith("\x01"):
             content = content[1:-1]
             if ' ' in content:
@@ -545,69 +1291,402 @@ class IRCClient(socketserver.StreamRequestHandler):
 
         for targetName in set(targets.split(',')):
             if targetName.startswith('#'):
-                target = self.fetch(lambda: self.findGroupByChannel_(targetName))
+                target = self.findGroupByChannel_(targetName)
             elif targetName.startswith('+'):
                 target = None
             else:
-                target = self.fetch(lambda: self.findBuddyByNick_(targetName))
+                target = self.findBuddyByNick_(targetName)
             if not target:
                 self.ircmsg(None, ERR_NOSUCHNICK, self.nick, targetName, 'No such nick/channel')
                 continue
-            self.server.bot.SendTo(target, content)
-
-    newLineRegex = re.compile("[\r\n]+")
-    # dialog: group or sender buddy
-    # member: member in channel
-    def onQQMessage_pending(self, *args, **kwargs):
-        self.qqMessageQueue.append((args, kwargs))
-
-    def onQQMessage_real(self, dialog, member, content):
-        if dialog.qq == '#NULL':
-            ERROR("missing dialog.qq for message %s" % content)
-            return
+            self.server.sendQueue.submit(target, content,
+                                         self.messageSent_(isNotice, targetName, original))
+
+    # reports the outcome of a queued QQ message back to this client
+    def messageSent_(self, isNotice, targetName, content):
+        def callback(error):
+            if error:
+                self.ircmsg(None, ERR_CANNOTSENDTOCHAN, self.nick, targetName, error)
+            elif 'echo-message' in self.caps:
+                self.ircmsg(self.me, 'NOTICE' if isNotice else 'PRIVMSG', targetName, content)
+        return callback
+
+    # message: QQMessage shared by every client
+    # kept in the server backlog until onProtocolDecided_
+    def onQQMessage_pending(self, message):
+        pass
 
-        if member is not None:
-            if member.qq == '#NULL':
-                ERROR("missing member.qq for message %s" % content)
-                return
-            sender = member
+    def onQQMessage_real(self, message):
+        if message.member is not None:
             try:
-                target = self.channelNames.toIRC[dialog.qq]
+                target = self.channelNames.toIRC[message.dialog.qq]
             except KeyError:
-                target = '#' + dialog.qq
-            isChannel = True
+                target = '#' + message.dialog.qq
+            viaRawChannel = target not in self.joinedChannels
         else:
-            sender = dialog
             target = self.me
-            isChannel = False
-        hostmask = self.server.buildHostmask(self.nickNames.toIRC[sender.qq], sender.qq)
+            viaRawChannel = False
+        self.backlogSeen[message.dialog.qq] = message.seq
 
-        for line in self.newLineRegex.split(content):
-            if isChannel and target not in self.joinedChannels:
-                self.ircmsg(hostmask, 'PRIVMSG', self.rawChannel, '%s: %s' % (target, line))
-            else:
-                self.ircmsg(hostmask, 'PRIVMSG', target, line)
+        self.sendEncoded(message.render(self.messageHostmask_(message), target, viaRawChannel),
+                         self.rawChannel if viaRawChannel else
+                         target if message.member is not None else self.nick)
+
+    def messageHostmask_(self, message):
+        sender = message.sender
+        return self.server.buildHostmask(self.ircNick_(sender.qq), sender.qq)
+
+class IRCClient(IRCClientBase, socketserver.StreamRequestHandler):
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.senderQueue = Lanes()
+        self.senderReady = threading.Condition()
+        self.senderThread = threading.current_thread()
+        self.setupClient()
+
+        reader = threading.Thread(target=self.reader)
+        reader.daemon = True
+        reader.start()
+
+    def handle(self):
+        self.sender()
 
-class IRCServer(socketserver.ThreadingTCPServer):
+    def finish(self):
+        self.server.removeClient(self)
+        socketserver.StreamRequestHandler.finish(self)
+        INFO("finish()")
+
+    def reader(self):
+        framer = LineFramer()
+        try:
+            while True:
+                lines = framer.recvFrom(self.connection)
+                if lines is None:
+                    break
+                for line in lines:
+                    self.received_(line)
+        finally:
+            INFO("reader thread exit")
+            self.sender_exit()
+
+    def reader_exit(self):
+        INFO("reader_exit()")
+
+    # sender
+    def sender(self):
+        try:
+            while True:
+                with self.senderReady:
+                    while not self.senderQueue:
+                        self.senderReady.wait()
+                    (lane, (f, args, kwargs)) = self.senderQueue.pop()
+                self.runTask_(lane, f, args, kwargs)
+
+        except SystemExit:
+            pass
+        finally:
+            INFO("sender thread exit")
+            self.reader_exit()
+
+    def sender_putIn(self, lane, f, *args, **kwargs):
+        with self.senderReady:
+            self.senderQueue.put(lane, (f, args, kwargs))
+            self.senderReady.notify()
+
+    # after the work already queued, bulk work aside
+    def sender_exit(self):
+        def exit():
+            raise SystemExit()
+        self.sender_put(exit)
+
+    def abortConnection(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+
+    # on the sender the buffer is written out here, each write given
+    # `drainTimeout` before the connection is aborted; a sync worker has the
+    # sender do it and waits
+    def drain_(self, encoded):
+        if threading.current_thread() is not self.senderThread:
+            self.sender_putIn(CONTROL, self.flush)
+            return self.output.waitRoom(encoded, self.drainTimeout)
+        while self.output.crowded(encoded):
+            timer = threading.Timer(self.drainTimeout, self.abortConnection)
+            timer.daemon = True
+            timer.start()
+            try:
+                self.flush()
+            finally:
+                timer.cancel()
+        return True
+
+    iovMax = 1024
+    def writeChunks(self, chunks):
+        if not hasattr(self.request, 'sendmsg'):
+            self.output.syscalls += 1
+            self.request.sendall(b''.join(chunks))
+            return
+
+        while chunks:
+            batch = chunks[:self.iovMax]
+            sent = self.request.sendmsg(batch)
+            self.output.syscalls += 1
+            done = 0
+            while done < len(batch) and sent >= len(batch[done]):
+                sent -= len(batch[done])
+                done += 1
+            chunks = chunks[done:]
+            if sent:
+                chunks[0] = chunks[0][sent:]
+
+class IRCServerBase(object):
     IsSupported_prefix = "(qo)~@"
     roleToPrefix = ['~@', '@', '', '']
 
-    def __init__(self, bot, address):
-        self.daemon_threads = True
-        self.allow_reuse_address = True
+    def setupServer(self, bot):
         self.bot = bot
         self.clients = set()
-        socketserver.ThreadingTCPServer.__init__(self, address, IRCClient)
+        self.namesCache = {}
+        self.whoCache = {}
+        self.channelNames = UniqNameMap(self, True)
+        self.numericChannelNames = UniqNameMap(self, True, named=False)
+        self.nickNames = UniqNameMap(self, False)
+        self.registeredGeneration = None
+        self.channelIndexes = {}
+        self.joinSync = self.option('IRCJoinSync', 'background')
+        self.detached = {}
+        self.sessionLock = threading.Lock()
+        self.sessionTTL = float(self.option('IRCSessionTTL', 3600))
+        self.maxMessageLines = int(self.option('IRCMaxMessageLines', 20))
+        self.syncPool = ThreadPoolExecutor(int(self.option('IRCJoinSyncWorkers', 4)))
+        self.backlog = Backlog(int(self.option('IRCBacklogMessages', 200)),
+                               int(self.option('IRCBacklogBytes', 65536)))
+        self.fanoutLock = threading.Lock()
+        self.metrics = Registry()
+        self.fetcher = Fetcher(float(self.option('IRCFetchTimeout', 30)), self.metrics,
+                               getattr(bot, 'Put', Put))
+        self.directory = ContactDirectory(self, float(self.option('IRCContactTTL', 300)))
+        self.snapshot = self.openSnapshot_()
+        self.sendQueue = SendQueue(self.sendTo_,
+                                   rate=float(self.option('IRCSendRate', 1.0)),
+                                   burst=float(self.option('IRCSendBurst', 5)),
+                                   globalRate=float(self.option('IRCSendGlobalRate', 3.0)),
+                                   globalBurst=float(self.option('IRCSendGlobalBurst', 10)),
+                                   window=float(self.option('IRCSendCoalesce', 0.3)))
+        StartDaemonThread(self.sendQueue.run)
+        self.ingest = IngestQueue(self.deliverQQMessage_,
+                                  capacity=int(self.option('IRCIngestCapacity', 1000)),
+                                  policy=self.option('IRCIngestPolicy', 'block'),
+                                  metrics=self.metrics)
+        StartDaemonThread(self.ingest.run)
+        self.setupMetrics()
+        if self.snapshot is not None:
+            self.warmStart_()
+
+    def setupMetrics(self):
+        metrics = self.metrics
+        metrics.gauge('irc_clients', 'Connected IRC clients', lambda: len(self.clients))
+        metrics.collector('irc_sender_queue_depth', 'Tasks waiting in each client sender queue',
+                'gauge', lambda: [({'nick': client.nick or '*'}, len(client.senderQueue))
+                                  for client in list(self.clients)])
+        metrics.collector('irc_output_pending_lines', 'Lines buffered for each client',
+                'gauge', lambda: [({'nick': client.nick or '*'}, client.output.pendingLines)
+                                  for client in list(self.clients)])
+        metrics.collector('irc_output_buffered_bytes', 'Bytes each client has not read yet',
+                'gauge', lambda: [({'nick': client.nick or '*'}, client.output.buffered())
+                                  for client in list(self.clients)])
+        metrics.gauge('irc_output_memory_bytes', 'Bytes buffered for all clients',
+                lambda: sum(client.output.buffered() for client in list(self.clients)))
+        metrics.collector('irc_output_dropped_total', 'Messages dropped for slow clients',
+                'counter', lambda: [({'nick': client.nick or '*'}, client.output.dropped)
+                                    for client in list(self.clients)])
+        metrics.collector('irc_output_bytes_total', 'Bytes flushed to each client',
+                'counter', lambda: [({'nick': client.nick or '*'}, client.output.bytes)
+                                    for client in list(self.clients)])
+        # with the two above, lines and bytes per flush and per write call
+        metrics.collector('irc_output_lines_total', 'Lines flushed to each client',
+                'counter', lambda: [({'nick': client.nick or '*'}, client.output.lines)
+                                    for client in list(self.clients)])
+        metrics.collector('irc_output_flushes_total', 'Flushes of each client output buffer',
+                'counter', lambda: [({'nick': client.nick or '*'}, client.output.flushes)
+                                    for client in list(self.clients)])
+        metrics.collector('irc_output_writes_total', 'Socket write calls made for each client',
+                'counter', lambda: [({'nick': client.nick or '*'}, client.output.syscalls)
+                                    for client in list(self.clients)])
+        metrics.collector('irc_output_max_flush_lines', 'Most lines one flush wrote to each client',
+                'gauge', lambda: [({'nick': client.nick or '*'}, client.output.maxFlushLines)
+                                  for client in list(self.clients)])
+        self.qqMessages = metrics.counter('qq_messages_total', 'QQ messages received')
+        self.fanoutDeliveries = metrics.counter('irc_fanout_deliveries_total',
+                'QQ messages delivered to IRC clients')
+        self.fanoutLines = metrics.counter('irc_fanout_lines_total',
+                'IRC lines produced by QQ message fan-out')
+        self.fanoutSeconds = metrics.histogram('irc_fanout_seconds',
+                'Time to fan one QQ message out to every client')
+        metrics.gauge('qq_send_queue_depth', 'Lines waiting to be sent to QQ', self.sendQueue.depth)
+        metrics.collector('qq_sends_total', 'QQ messages sent, by result', 'counter',
+                lambda: [({'result': 'ok'}, self.sendQueue.sent),
+                         ({'result': 'error'}, self.sendQueue.failed)])
+        metrics.collector('qq_send_merged_lines_total', 'IRC lines merged into a previous QQ message',
+                'counter', lambda: [({}, self.sendQueue.merged)])
+        metrics.gauge('qq_backlog_messages', 'Messages kept in the backlog',
+                lambda: self.backlog.stats()['messages'])
+        metrics.gauge('qq_backlog_bytes', 'Bytes kept in the backlog',
+                lambda: self.backlog.stats()['bytes'])
+        metrics.gauge('qq_directory_generation', 'Contact directory loads',
+                lambda: self.directory.generation)
+        metrics.gauge('qq_directory_live', 'Whether the contact directory was loaded from QQ '
+                '(1) or from the snapshot (0)', lambda: int(self.directory.live))
+
+        address = self.option('IRCMetricsAddress')
+        if address:
+            (host, port) = (['127.0.0.1'] + str(address).rsplit(':', 1))[-2:]
+            serveMetrics(metrics, (host or '127.0.0.1', int(port)))
+
+    def option(self, name, default=None):
+        return getattr(self.bot.conf, name, default)
+
+    # IRCSnapshotPath, where {qq} stands for the account; by default a file
+    # next to qqbot's own, none if the account or the place is unknown
+    def openSnapshot_(self):
+        conf = self.bot.conf
+        path = self.option('IRCSnapshotPath')
+        if path is None and hasattr(conf, 'absPath'):
+            path = conf.absPath('irc-directory-{qq}.db')
+        if not path or getattr(conf, 'qq', None) is None:
+            return None
+        return Snapshot(path.format(qq=conf.qq))
+
+    # names of the snapshot entries
+    def snapshotMaps_(self):
+        return {'channel': self.channelNames, 'nick': self.nickNames}
+
+    # serve the snapshot until the directory has been loaded from QQ
+    def warmStart_(self):
+        loaded = self.snapshot.load()
+        if loaded is not None:
+            (groups, members, buddies, names) = loaded
+            for (name, nameMap) in self.snapshotMaps_().items():
+                nameMap.preload(names.get(name, {}))
+            self.directory.install(groups, members, buddies, live=False)
+        StartDaemonThread(self.directory.refresh)
+
+    # called by the directory after each load from QQ
+    def directoryLoaded(self):
+        if self.snapshot is not None:
+            self.syncPool.submit(self.saveSnapshot_)
+
+    def saveSnapshot_(self):
+        try:
+            self.registerNames()
+            directory = self.directory
+            self.snapshot.save(directory.groups, directory.members, directory.buddies,
+                               dict((name, nameMap.names())
+                                    for (name, nameMap) in self.snapshotMaps_().items()))
+        except Exception:
+            EXCEPTION("failed to save the directory snapshot")
+
+    # snapshot contacts are not the bot's; send to the live contact instead
+    def sendTo_(self, contact, content):
+        if isinstance(contact, SnapshotContact):
+            live = self.directory.liveContact(contact)
+            if live is None:
+                return '错误：%s %s is not a QQ contact' % (contact.ctype, contact.qq)
+            contact = live
+        return self.bot.SendTo(contact, content)
+
+    # calls submitted to it run on the qqbot mainloop in one round trip
+    def batch(self, timeout=None):
+        return self.fetcher.batch(timeout)
+
+    # give every directory entry its IRC name, once per directory load
+    def registerNames(self):
+        self.directory.ensure()
+        generation = self.directory.generation
+        if generation == self.registeredGeneration:
+            return
+        for group in self.directory.listGroups():
+            self.channelNames.register(group.name, group.qq)
+            self.numericChannelNames.register(group.name, group.qq)
+        for member in self.directory.listAllMembers():
+            self.nickNames.register(member.name, member.qq)
+        for buddy in self.directory.listBuddies():
+            self.nickNames.register(buddy.name, buddy.qq)
+        self.registeredGeneration = generation
+
+    # LIST index of `nameMap`, rebuilt once per directory load
+    def channelIndex(self, nameMap):
+        self.registerNames()
+        generation = self.directory.generation
+        index = self.channelIndexes.get(nameMap.named)
+        if index is None or index.generation != generation:
+            index = self.channelIndexes[nameMap.named] = ChannelIndex(generation, nameMap, self.directory)
+        return index
 
     def addClient(self, client):
         self.clients.add(client)
 
     def removeClient(self, client):
-        self.clients.remove(client)
-
+        self.clients.discard(client)
+        client.releaseNick_()
+        session = client.detach_() if self.sessionTTL > 0 else None
+        if session is not None:
+            with self.sessionLock:
+                self.expireSessions_()
+                self.detached[session.key] = session
+            INFO("detached session of %s" % client.nick)
+
+    def takeSession(self, nick, password):
+        with self.sessionLock:
+            self.expireSessions_()
+            return self.detached.pop((ircutils.toLower(nick), password), None)
+
+    def expireSessions_(self):
+        cutoff = time.time() - self.sessionTTL
+        for (key, session) in list(self.detached.items()):
+            if session.detachedAt < cutoff:
+                del self.detached[key]
+
+    # the server (QQ account) a registering client belongs to, None to
+    # refuse it; a single-account server takes everyone
+    def route(self, client):
+        return self
+
+    def onUpdate(self, tinfo):
+        self.directory.invalidate()
+
+    # called on the qqbot poll loop: only hands the message over
     def onQQMessage(self, contact, member, content):
-        for client in self.clients:
-            client.onQQMessage(contact, member, content)
+        self.ingest.put(contact, member, content)
+
+    def deliverQQMessage_(self, received, contact, member, content):
+        if contact.qq == '#NULL':
+            ERROR("missing dialog.qq for message %s" % content)
+            return
+        if member is not None and member.qq == '#NULL':
+            ERROR("missing member.qq for message %s" % content)
+            return
+
+        # the sender may be newer than the directory
+        sender = member if member is not None else contact
+        self.nickNames.register(getattr(sender, 'name', None), sender.qq)
+
+        message = QQMessage(contact, member, content, self.maxMessageLines, received)
+        start = time.time()
+        with self.fanoutLock:
+            self.backlog.append(message)
+            clients = list(self.clients)
+            for client in clients:
+                try:
+                    client.onQQMessage(message)
+                except Exception:
+                    EXCEPTION("failed to deliver a QQ message to %s" % client.nick)
+        self.fanoutSeconds.observe(time.time() - start)
+        self.qqMessages.inc()
+        self.fanoutDeliveries.inc(len(clients))
+        self.fanoutLines.inc(len(clients) * len(message.lines))
 
     invalidNickChars = { ord(c): '_' for c in '# 　\t!~@$&'}
     def toIrcNick(self, nick):
@@ -616,11 +1695,12 @@ class IRCServer(socketserver.ThreadingTCPServer):
     def buildHostmask(self, nick, guin):
         return "%s!%s@qq.com" % (nick, guin)
 
-    colorRegex = re.compile(r'\x03[0-9]{1,2}(?:,[0-9]{1,2})?') # color
-    hiddenRegex = re.compile(r'\x030,0.*') # color white,white
-    colorModeRegex = re.compile(r'\x03|\x02|\x16|\x1F|\x1D') # color, bold, reverse, underline, italics
     def stripColorCode(self, content):
-        content = self.hiddenRegex.sub('', content)
-        content = self.colorRegex.sub('', content)
-        content = self.colorModeRegex.sub('', content)
-        return content
+        return ircToQQ(content)
+
+class IRCServer(IRCServerBase, socketserver.ThreadingTCPServer):
+    def __init__(self, bot, address):
+        self.daemon_threads = True
+        self.allow_reuse_address = True
+        self.setupServer(bot)
+        socketserver.ThreadingTCPServer.__init__(self, address, IRCClient)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+
+from qqbot.utf8logger import EXCEPTION
+
+from Metrics import Registry
+
+# Inbound QQ events between the qqbot poll loop and the IRC side.  `put`
+# only appends to a bounded deque, so the poll loop never waits on fan-out
+# to clients; the queue's own thread calls deliver(enqueuedAt, *args) in
+# arrival order.  When `capacity` events are waiting, `policy` decides:
+# 'block' makes `put` wait for room, 'drop-newest' discards the new event
+# and 'drop-oldest' the oldest waiting one.
+class IngestQueue(object):
+    policies = ('block', 'drop-newest', 'drop-oldest')
+
+    def __init__(self, deliver, capacity=1000, policy='block', metrics=None):
+        if policy not in self.policies:
+            raise ValueError("unknown ingest policy %r" % policy)
+        self.deliver = deliver
+        self.capacity = max(1, capacity)
+        self.policy = policy
+        self.cv = threading.Condition()
+        self.events = collections.deque()
+
+        self.metrics = metrics if metrics is not None else Registry()
+        self.received = self.metrics.counter('qq_ingest_events_total',
+                'QQ events handed over by the poll loop')
+        self.dropped = self.metrics.counter('qq_ingest_dropped_total',
+                'QQ events dropped because the ingest queue was full')
+        self.waits = self.metrics.histogram('qq_ingest_wait_seconds',
+                'Time QQ events spent in the ingest queue')
+        self.metrics.gauge('qq_ingest_queue_depth', 'QQ events waiting to be delivered',
+                self.depth)
+
+    def put(self, *args):
+        with self.cv:
+            if len(self.events) >= self.capacity:
+                if self.policy == 'drop-newest':
+                    self.dropped.inc()
+                    return False
+                elif self.policy == 'drop-oldest':
+                    self.events.popleft()
+                    self.dropped.inc()
+                else:
+                    while len(self.events) >= self.capacity:
+                        self.cv.wait()
+            self.events.append((time.time(), args))
+            self.received.inc()
+            self.cv.notify_all()
+            return True
+
+    def depth(self):
+        return len(self.events)
+
+    def run(self):
+        while True:
+            with self.cv:
+                while not self.events:
+                    self.cv.wait()
+                (enqueuedAt, args) = self.events.popleft()
+                self.cv.notify_all()
+            self.waits.observe(time.time() - enqueuedAt)
+            try:
+                self.deliver(enqueuedAt, *args)
+            except Exception:
+                EXCEPTION("failed to deliver QQ event")
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import collections
+
+CONTROL = 'control'
+INTERACTIVE = 'interactive'
+
+def bulk(key):
+    return ('bulk', key)
+
+# Work waiting for one client, by priority: everything in the control lane
+# goes before the interactive lane, which goes before bulk traffic.  Bulk
+# traffic is split by key (a channel, a NAMES or WHO request...) and the
+# keys take turns one item at a time, so one large dump cannot hold up the
+# others.  Order is kept within a lane.  Not locked.
+class Lanes(object):
+    def __init__(self):
+        self.control = collections.deque()
+        self.interactive = collections.deque()
+        self.bulk = collections.OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def lane_(self, lane):
+        if lane == CONTROL:
+            return self.control
+        elif lane == INTERACTIVE:
+            return self.interactive
+        queue = self.bulk.get(lane)
+        if queue is None:
+            queue = self.bulk[lane] = collections.deque()
+        return queue
+
+    def put(self, lane, item):
+        self.lane_(lane).append(item)
+        self.size += 1
+
+    # `item` goes first in its lane, as for the rest of one just popped
+    def putFront(self, lane, item):
+        self.lane_(lane).appendleft(item)
+        self.size += 1
+
+    # (lane, item) of the item to serve next, None if empty
+    def pop(self):
+        if self.control:
+            lane = CONTROL
+            item = self.control.popleft()
+        elif self.interactive:
+            lane = INTERACTIVE
+            item = self.interactive.popleft()
+        elif self.bulk:
+            (lane, queue) = self.bulk.popitem(last=False)
+            item = queue.popleft()
+            if queue:
+                self.bulk[lane] = queue
+        else:
+            return None
+        self.size -= 1
+        return (lane, item)
+
+    # drops the items `keep` refuses and returns them
+    def filter(self, keep):
+        removed = []
+        for queue in [self.control, self.interactive] + list(self.bulk.values()):
+            kept = [item for item in queue if keep(item)]
+            if len(kept) != len(queue):
+                removed.extend(item for item in queue if not keep(item))
+                queue.clear()
+                queue.extend(kept)
+        for (lane, queue) in list(self.bulk.items()):
+            if not queue:
+                del self.bulk[lane]
+        self.size -= len(removed)
+        return removed
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from qqbot.utf8logger import INFO
+from qqbot.mainloop import StartDaemonThread
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self):
+        return [('', (), self.value)]
+
+class Gauge(object):
+    kind = 'gauge'
+
+    # `fn`, when given, is called for the value at collection time
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [('', (), self.fn() if self.fn else self.value)]
+
+class Histogram(object):
+    kind = 'histogram'
+    defaultBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                      0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=defaultBuckets):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    # cumulative (upper bound, count) pairs, the last bound being None (+Inf)
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            (count, total) = (self.count, self.sum)
+        cumulative = []
+        running = 0
+        for (bound, n) in zip(self.buckets + (None,), counts):
+            running += n
+            cumulative.append((bound, running))
+        return (cumulative, count, total)
+
+    def samples(self):
+        (cumulative, count, total) = self.snapshot()
+        samples = [('_bucket', (('le', '+Inf' if bound is None else repr(bound)),), n)
+                   for (bound, n) in cumulative]
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), count))
+        return samples
+
+# Samples computed at collection time, one per label set: `fn` returns
+# [(labels, value)], e.g. one queue depth per connected client.
+class Collector(object):
+    def __init__(self, kind, fn):
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        return [('', tuple(sorted(labels.items())), value) for (labels, value) in self.fn()]
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                                        .replace('"', '\\"')
+                                                        .replace('\n', '\\n'))
+                             for (key, value) in labels)
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+# Named metrics of a server, rendered in the Prometheus text exposition
+# format.  A metric is identified by its name and labels; asking for it
+# again returns the same instance.
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.helps = {}
+        self.metrics = {}
+
+    def get_(self, name, help, labels, factory):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = factory()
+                self.helps.setdefault(name, help)
+            return metric
+
+    def counter(self, name, help='', labels=None):
+        return self.get_(name, help, labels, Counter)
+
+    def gauge(self, name, help='', fn=None, labels=None):
+        return self.get_(name, help, labels, lambda: Gauge(fn))
+
+    def histogram(self, name, help='', labels=None, buckets=Histogram.defaultBuckets):
+        return self.get_(name, help, labels, lambda: Histogram(buckets))
+
+    def collector(self, name, help, kind, fn):
+        return self.get_(name, help, None, lambda: Collector(kind, fn))
+
+    # [(labels, metric)] of every metric called `name`
+    def family(self, name):
+        with self.lock:
+            return [(dict(labels), metric) for ((key, labels), metric)
+                    in sorted(self.metrics.items(), key=lambda item: item[0]) if key == name]
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+            helps = dict(self.helps)
+        lines = []
+        current = None
+        for ((name, labels), metric) in metrics:
+            if name != current:
+                current = name
+                if helps.get(name):
+                    lines.append('# HELP %s %s' % (name, helps[name]))
+                lines.append('# TYPE %s %s' % (name, metric.kind))
+            for (suffix, extra, value) in metric.samples():
+                lines.append('%s%s%s %s' % (name, suffix, formatLabels(labels + extra),
+                                            formatValue(value)))
+        return lines
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = ('\n'.join(self.server.registry.render()) + '\n').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, registry, address):
+        self.registry = registry
+        HTTPServer.__init__(self, address, MetricsHandler)
+
+# serves `registry` over HTTP on `address` from a daemon thread
+def serveMetrics(registry, address):
+    server = MetricsServer(registry, address)
+    StartDaemonThread(server.serve_forever)
+    INFO("metrics available at http://%s:%d/metrics" % server.server_address[:2])
+    return server
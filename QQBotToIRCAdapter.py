@@ -17,14 +17,29 @@ class QQBotToIRCAdapter(QQBot):
         self.server = None
 
     def onQQMessage(self, contact, member, content):
-        content = content.replace('&lt;', '<')
-        content = content.replace('&gt;', '>')
+        # entities are decoded by IRCServer, once per message
         if self.server:
             self.server.onQQMessage(contact, member, content)
 
+    def onUpdate(self, tinfo):
+        if self.server:
+            self.server.onUpdate(tinfo)
+
     def onStartupComplete(self):
+        # started by a Sharding front end: serve it instead of listening
+        if os.environ.get('OINK_FRONTEND'):
+            from Sharding import ShardWorker
+            self.server = ShardWorker(self, os.environ['OINK_FRONTEND'],
+                                      os.environ['OINK_FRONTEND_KEY'], os.environ['OINK_ACCOUNT'])
+            StartDaemonThread(self.server.serve_forever)
+            return
         ip, port = (self.conf.IRCServerAddress.split(':', 1) + [6667])[0:2]
-        self.server = IRCServer(self, (ip, int(port)))
+        if getattr(self.conf, 'IRCServerMode', 'thread') == 'asyncio':
+            from AsyncIRCServer import AsyncIRCServer
+            workers = int(getattr(self.conf, 'IRCServerWorkers', 8))
+            self.server = AsyncIRCServer(self, (ip, int(port)), workers)
+        else:
+            self.server = IRCServer(self, (ip, int(port)))
         StartDaemonThread(self.server.serve_forever)
 
 if __name__ == '__main__':
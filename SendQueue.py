@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+
+from qqbot.utf8logger import ERROR, DEBUG
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+
+    def refill_(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # when the next token is available
+    def readyAt(self, now):
+        self.refill_(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill_(now)
+        self.tokens -= 1
+
+class SendBatch(object):
+    __slots__ = ('target', 'lines', 'size', 'callbacks', 'since')
+
+    def __init__(self, target, now):
+        self.target = target
+        self.lines = []
+        self.size = 0
+        self.callbacks = []
+        self.since = now
+
+# Outbound QQ messages.  Lines for the same target arriving within
+# `window` seconds are merged into one QQ message; sends are paced by a
+# token bucket per target and one shared by all targets, and run on the
+# queue's own thread.  Each submitter gets callback(error) once its line
+# went out, error being None on success.
+class SendQueue(object):
+    def __init__(self, send, rate=1.0, burst=5, globalRate=3.0, globalBurst=10,
+                 window=0.3, maxChars=1500):
+        self.send = send
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.maxChars = maxChars
+        self.cv = threading.Condition()
+        self.globalBucket = TokenBucket(globalRate, globalBurst)
+        self.buckets = {}
+        self.batches = collections.OrderedDict()
+
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+
+    def submit(self, target, content, callback=None):
+        with self.cv:
+            now = time.time()
+            batches = self.batches.get(target.qq)
+            if batches is None:
+                batches = self.batches[target.qq] = collections.deque()
+            if not batches or batches[-1].size + len(content) > self.maxChars:
+                batches.append(SendBatch(target, now))
+            batch = batches[-1]
+            batch.lines.append(content)
+            batch.size += len(content) + 1
+            if callback:
+                batch.callbacks.append(callback)
+            self.cv.notify()
+
+    def depth(self):
+        with self.cv:
+            return sum(len(batch.lines) for batches in self.batches.values()
+                                        for batch in batches)
+
+    def next_(self, now):
+        readyAt = None
+        for (qq, batches) in self.batches.items():
+            bucket = self.buckets.get(qq)
+            if bucket is None:
+                bucket = self.buckets[qq] = TokenBucket(self.rate, self.burst)
+            # a full batch need not wait for more lines
+            batch = batches[0]
+            at = batch.since + self.window if len(batches) == 1 else now
+            at = max(at, bucket.readyAt(now), self.globalBucket.readyAt(now))
+            if at <= now:
+                batches.popleft()
+                if not batches:
+                    del self.batches[qq]
+                bucket.take(now)
+                self.globalBucket.take(now)
+                return (batch, None)
+            readyAt = at if readyAt is None else min(readyAt, at)
+        return (None, readyAt)
+
+    def run(self):
+        while True:
+            with self.cv:
+                while True:
+                    now = time.time()
+                    (batch, readyAt) = self.next_(now)
+                    if batch:
+                        break
+                    self.cv.wait(None if readyAt is None else readyAt - now)
+            self.deliver_(batch)
+
+    def deliver_(self, batch):
+        error = None
+        try:
+            result = self.send(batch.target, '\n'.join(batch.lines))
+            # qqbot reports failures as a result string starting with 错误
+            if isinstance(result, str) and result.startswith('错误'):
+                error = result
+        except Exception as e:
+            ERROR("failed to send to %s: %s" % (batch.target.qq, e))
+            error = str(e) or e.__class__.__name__
+
+        if error:
+            self.failed += 1
+        else:
+            self.sent += 1
+            self.merged += len(batch.lines) - 1
+            DEBUG("sent %d lines to %s" % (len(batch.lines), batch.target.qq))
+        for callback in batch.callbacks:
+            try:
+                callback(error)
+            except Exception as e:
+                ERROR("send callback failed: %s" % e)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+# One IRC front end for several QQ accounts.  Each account runs the usual
+# QQBotToIRCAdapter (and its qqbot login) in a worker process of its own;
+# the worker connects back to the front end over a local, authenticated
+# multiprocessing connection and serves List/SendTo calls and forwards QQ
+# events.  The front end keeps one IRCSession (name maps, directory,
+# backlog, send queue) per account and routes every registering client to
+# the session its PASS (and, if several accounts share it, USER) selects.
+#
+#   python3 Sharding.py --listen 0.0.0.0:6667 \
+#       --account work:secret:qqbotUser1 --account home:secret2:qqbotUser2 \
+#       [--option IRCBacklogMessages=500 ...]
+
+import argparse
+import binascii
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from qqbot.utf8logger import ERROR, EXCEPTION, INFO
+from qqbot.mainloop import StartDaemonThread, Put
+from qqbot.common import Queue
+
+from IRCServer import IRCClient, IRCServerBase, IrcError
+
+# Contacts cross the process boundary as plain attribute dicts
+class RemoteContact(object):
+    def __init__(self, attrs):
+        self.__dict__.update(attrs)
+
+    def __repr__(self):
+        return 'RemoteContact(%s, %s)' % (self.ctype, getattr(self, 'qq', None))
+
+def toRecord(contact):
+    if contact is None:
+        return None
+    return dict((k, v) for (k, v) in vars(contact).items() if not k.startswith('_'))
+
+def fromRecord(record):
+    return RemoteContact(record) if isinstance(record, dict) else record
+
+class SessionConf(object):
+    def __init__(self, options):
+        self.qq = None
+        self.__dict__.update(options)
+
+# Stands in for the QQBot of one account on the front end.  List and SendTo
+# are forwarded to the worker process; `Put` runs fetches on this account's
+# own thread so that a slow account only delays itself.
+class RemoteBot(object):
+    def __init__(self, name, conf):
+        self.name = name
+        self.conf = conf
+        self.session = None
+        self.lock = threading.Lock()
+        self.sendLock = threading.Lock()
+        self.conn = None
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.timeout = float(getattr(conf, 'IRCFetchTimeout', 30))
+        self.tasks = Queue.Queue()
+        StartDaemonThread(self.runTasks_)
+
+    def Put(self, func, *args, **kwargs):
+        self.tasks.put((func, args, kwargs))
+
+    def runTasks_(self):
+        while True:
+            (func, args, kwargs) = self.tasks.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                EXCEPTION("task of account %s failed" % self.name)
+
+    def isConnected(self):
+        return self.conn is not None
+
+    def attach(self, conn, qq):
+        with self.lock:
+            (old, self.conn) = (self.conn, conn)
+            self.conf.qq = qq
+        if old is not None:
+            old.close()
+        INFO("account %s (%s) connected" % (self.name, qq))
+        StartDaemonThread(self.reader_, conn)
+
+    def List(self, tinfo, cinfo=None):
+        result = self.call_('List', tinfo, cinfo)
+        if result is not None:
+            result = [fromRecord(record) for record in result]
+        return result
+
+    def SendTo(self, contact, content):
+        return self.call_('SendTo', contact, content)
+
+    def call_(self, method, *args):
+        future = Future()
+        with self.lock:
+            conn = self.conn
+            if conn is None:
+                raise IOError("QQ account %s is not connected" % self.name)
+            callId = next(self.ids)
+            self.pending[callId] = (conn, future)
+        args = tuple(toRecord(arg) if isinstance(arg, RemoteContact) else arg for arg in args)
+        try:
+            with self.sendLock:
+                conn.send(('call', callId, method, args))
+            return future.result(self.timeout)
+        finally:
+            with self.lock:
+                self.pending.pop(callId, None)
+
+    def reader_(self, conn):
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'reply':
+                    (_, callId, error, result) = message
+                    with self.lock:
+                        entry = self.pending.get(callId)
+                    if entry is None:
+                        continue
+                    if error is None:
+                        entry[1].set_result(result)
+                    else:
+                        entry[1].set_exception(IOError(error))
+                elif message[0] == 'event':
+                    (_, event, args) = message
+                    getattr(self.session, event)(*[fromRecord(arg) for arg in args])
+        except (EOFError, IOError, OSError) as e:
+            ERROR("account %s disconnected: %s" % (self.name, e))
+        except Exception:
+            EXCEPTION("account %s: bad message" % self.name)
+        finally:
+            with self.lock:
+                if self.conn is conn:
+                    self.conn = None
+                failed = [future for (c, future) in self.pending.values() if c is conn]
+            for future in failed:
+                if not future.done():
+                    future.set_exception(IOError("QQ account %s disconnected" % self.name))
+            conn.close()
+
+# The per-account state of IRCServerBase without a listener of its own
+class IRCSession(IRCServerBase):
+    def __init__(self, name, password, user, bot):
+        self.name = name
+        self.password = password
+        self.user = user
+        bot.session = self
+        self.setupServer(bot)
+
+# Clients register against the front end (an IRCServerBase over a bot that
+# knows no contacts) and are moved to their account's session by route().
+class LobbyBot(object):
+    def __init__(self, conf):
+        self.conf = conf
+
+    def List(self, tinfo, cinfo=None):
+        return []
+
+    def SendTo(self, contact, content):
+        return '错误：not logged in'
+
+class ShardedIRCServer(IRCServerBase, socketserver.ThreadingTCPServer):
+    def __init__(self, address, options, ipcAddress=('127.0.0.1', 0)):
+        self.daemon_threads = True
+        self.allow_reuse_address = True
+        self.setupServer(LobbyBot(SessionConf(options)))
+        self.sessionOptions = dict((k, v) for (k, v) in options.items()
+                                   if k != 'IRCMetricsAddress')
+        self.sessions = {}
+        self.authkey = os.urandom(16)
+        self.ipc = Listener(ipcAddress, authkey=self.authkey)
+        StartDaemonThread(self.acceptWorkers_)
+        socketserver.ThreadingTCPServer.__init__(self, address, IRCClient)
+
+    def addAccount(self, name, password, user=None):
+        bot = RemoteBot(name, SessionConf(self.sessionOptions))
+        self.sessions[name] = IRCSession(name, password, user, bot)
+
+    def acceptWorkers_(self):
+        while True:
+            try:
+                conn = self.ipc.accept()
+                (kind, name, qq) = conn.recv()
+            except Exception as e:
+                ERROR("rejected worker connection: %s" % e)
+                continue
+            session = self.sessions.get(name)
+            if kind != 'hello' or session is None:
+                ERROR("unknown account %s" % name)
+                conn.close()
+                continue
+            session.bot.attach(conn, qq)
+
+    # PASS picks the account; USER only breaks ties between accounts
+    # sharing a password
+    def route(self, client):
+        candidates = [session for session in self.sessions.values()
+                      if session.password == client.password]
+        named = [session for session in candidates
+                 if session.user is not None and session.user == client.username]
+        if named:
+            candidates = named
+        if len(candidates) != 1:
+            return None
+        session = candidates[0]
+        if not session.bot.isConnected():
+            raise IrcError("QQ account %s is not connected" % session.name)
+        return session
+
+    # runs QQBotToIRCAdapter for qqbot user `qqbotUser` as the worker of
+    # account `name`
+    def spawnWorker(self, name, qqbotUser):
+        env = dict(os.environ)
+        env['OINK_FRONTEND'] = '%s:%d' % self.ipc.address
+        env['OINK_FRONTEND_KEY'] = binascii.hexlify(self.authkey).decode('ascii')
+        env['OINK_ACCOUNT'] = name
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.Popen([sys.executable, os.path.join(here, 'QQBotToIRCAdapter.py'),
+                                 '-u', qqbotUser], env=env, cwd=here)
+
+# The worker side: takes the place of the IRCServer in QQBotToIRCAdapter.
+class ShardWorker(object):
+    def __init__(self, bot, address, authkey, name):
+        (host, port) = address.rsplit(':', 1)
+        self.bot = bot
+        self.address = (host, int(port))
+        self.authkey = binascii.unhexlify(authkey)
+        self.name = name
+        self.conn = None
+        self.sendLock = threading.Lock()
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+                conn.send(('hello', self.name, self.bot.conf.qq))
+            except Exception as e:
+                ERROR("cannot reach the IRC front end: %s" % e)
+                time.sleep(5)
+                continue
+            self.conn = conn
+            try:
+                while True:
+                    (_, callId, method, args) = conn.recv()
+                    Put(self.call_, conn, callId, method, args)
+            except (EOFError, IOError, OSError) as e:
+                ERROR("lost the IRC front end: %s" % e)
+            self.conn = None
+            conn.close()
+            time.sleep(1)
+
+    def send_(self, conn, message):
+        if conn is None:
+            return
+        try:
+            with self.sendLock:
+                conn.send(message)
+        except (IOError, OSError) as e:
+            ERROR("failed to reach the IRC front end: %s" % e)
+
+    # runs on the qqbot mainloop
+    def call_(self, conn, callId, method, args):
+        try:
+            args = [self.resolve_(arg) for arg in args]
+            if method == 'List':
+                result = self.bot.List(*args)
+                if result is not None:
+                    result = [toRecord(contact) for contact in result]
+            elif method == 'SendTo':
+                result = self.bot.SendTo(*args)
+            else:
+                raise ValueError("unknown call %s" % method)
+        except Exception as e:
+            self.send_(conn, ('reply', callId, str(e) or e.__class__.__name__, None))
+        else:
+            self.send_(conn, ('reply', callId, None, result))
+
+    def resolve_(self, arg):
+        if not isinstance(arg, dict):
+            return arg
+        found = self.bot.List(arg['ctype'], 'uin=' + arg['uin'])
+        if not found:
+            raise KeyError("%s %s is gone" % (arg['ctype'], arg['uin']))
+        return found[0]
+
+    def onQQMessage(self, contact, member, content):
+        self.send_(self.conn, ('event', 'onQQMessage', (toRecord(contact), toRecord(member), content)))
+
+    def onUpdate(self, tinfo):
+        if not isinstance(tinfo, str):
+            tinfo = toRecord(tinfo)
+        self.send_(self.conn, ('event', 'onUpdate', (tinfo,)))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='IRC front end for several QQ accounts')
+    parser.add_argument('--listen', default='127.0.0.1:6667')
+    parser.add_argument('--account', action='append', default=[],
+                        help='NAME:PASSWORD[:QQBOT_USER], QQBOT_USER starts a worker')
+    parser.add_argument('--option', action='append', default=[],
+                        help='KEY=VALUE, passed to every account like a qqbot conf entry')
+    args = parser.parse_args(argv[1:])
+
+    options = dict(option.split('=', 1) for option in args.option)
+    (host, port) = (args.listen.rsplit(':', 1) + ['6667'])[:2]
+    server = ShardedIRCServer((host, int(port)), options)
+    workers = []
+    for account in args.account:
+        (name, password, qqbotUser) = (account.split(':', 2) + [None])[:3]
+        server.addAccount(name, password, name)
+        if qqbotUser:
+            workers.append(server.spawnWorker(name, qqbotUser))
+    try:
+        server.serve_forever()
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sqlite3
+import threading
+import time
+
+from qqbot.utf8logger import ERROR, INFO
+
+# A contact as saved in the snapshot: the attributes of the bot's contact
+# object, without the object.  Messages to it go to the live contact of the
+# same qq once the directory has been loaded from QQ.
+class SnapshotContact(object):
+    def __init__(self, attrs):
+        self.__dict__.update(attrs)
+
+    def __repr__(self):
+        return 'SnapshotContact(%s, %s)' % (getattr(self, 'ctype', None), getattr(self, 'qq', None))
+
+def attrsOf(contact):
+    return dict((k, v) for (k, v) in vars(contact).items() if not k.startswith('_'))
+
+# The contact directory and the IRC names given to its entries, saved in a
+# SQLite file after every load from QQ so that a restart can serve JOINs
+# before QQ answers and gives everyone the name it had before.  Names are
+# kept for contacts that went away, should they come back.
+class Snapshot(object):
+    version = '1'
+    schema = [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE IF NOT EXISTS contacts (kind TEXT, owner TEXT, position INTEGER,"
+        " attrs TEXT)",
+        "CREATE TABLE IF NOT EXISTS names (map TEXT, qq TEXT, name TEXT,"
+        " PRIMARY KEY (map, qq))",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def connect_(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        for statement in self.schema:
+            db.execute(statement)
+        return db
+
+    # (groups, members by group qq, buddies, {map: {qq: name}}), or None
+    # if there is no usable snapshot
+    def load(self):
+        try:
+            with self.lock:
+                db = self.connect_()
+                try:
+                    meta = dict(db.execute("SELECT key, value FROM meta"))
+                    if meta.get('version') != self.version:
+                        return None
+                    contacts = db.execute("SELECT kind, owner, attrs FROM contacts"
+                                          " ORDER BY kind, owner, position").fetchall()
+                    names = db.execute("SELECT map, qq, name FROM names").fetchall()
+                finally:
+                    db.close()
+        except (sqlite3.Error, ValueError) as e:
+            ERROR("cannot read the directory snapshot %s: %s" % (self.path, e))
+            return None
+
+        (groups, members, buddies) = ([], {}, [])
+        for (kind, owner, attrs) in contacts:
+            contact = SnapshotContact(json.loads(attrs))
+            if kind == 'group':
+                groups.append(contact)
+            elif kind == 'buddy':
+                buddies.append(contact)
+            else:
+                members.setdefault(owner, []).append(contact)
+        for group in groups:
+            members.setdefault(group.qq, [])
+        nameMaps = {}
+        for (nameMap, qq, name) in names:
+            nameMaps.setdefault(nameMap, {})[qq] = name
+        INFO("directory snapshot of %s loaded: %d groups, %d buddies" %
+                (time.ctime(float(meta.get('saved', 0))), len(groups), len(buddies)))
+        return (groups, members, buddies, nameMaps)
+
+    def save(self, groups, members, buddies, nameMaps):
+        rows = [('group', '', i, json.dumps(attrsOf(group), default=str))
+                for (i, group) in enumerate(groups)]
+        rows += [('buddy', '', i, json.dumps(attrsOf(buddy), default=str))
+                 for (i, buddy) in enumerate(buddies)]
+        for group in groups:
+            rows += [('member', group.qq, i, json.dumps(attrsOf(member), default=str))
+                     for (i, member) in enumerate(members.get(group.qq) or [])]
+        names = [(nameMap, qq, name) for (nameMap, toIRC) in nameMaps.items()
+                                     for (qq, name) in toIRC.items()]
+        try:
+            with self.lock:
+                db = self.connect_()
+                try:
+                    with db:
+                        db.execute("DELETE FROM contacts")
+                        db.executemany("INSERT INTO contacts VALUES (?, ?, ?, ?)", rows)
+                        db.executemany("INSERT OR REPLACE INTO names VALUES (?, ?, ?)", names)
+                        db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                       [('version', self.version), ('saved', str(time.time()))])
+                finally:
+                    db.close()
+        except sqlite3.Error as e:
+            ERROR("cannot write the directory snapshot %s: %s" % (self.path, e))
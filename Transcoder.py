@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+try:
+    from html.entities import name2codepoint
+    unichr = chr
+except ImportError:
+    from htmlentitydefs import name2codepoint
+
+# IRC -> QQ: drop every formatting code in one regex pass: bold, reset,
+# monospace, reverse, italics, strikethrough, underline, and the mIRC (\x03)
+# and hex (\x04) colours with their arguments.  White on white (hidden) text
+# is dropped up to the end of the line.
+ircFormatRegex = re.compile(
+    r'[\x02-\x04\x0f\x11\x16\x1d-\x1f]'
+    r'(?:(?<=\x03)(?:0{1,2},0{1,2}.*|[0-9]{1,2}(?:,[0-9]{1,2})?)'
+    r'|(?<=\x04)[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?')
+
+def ircToQQ(text):
+    # most chat lines carry no formatting; a failed search is cheaper than sub
+    if ircFormatRegex.search(text) is None:
+        return text
+    return ircFormatRegex.sub('', text)
+
+# QQ -> IRC: decode every HTML entity (and qqbot's non-breaking spaces) in
+# one regex pass.  A message starting with "/me " becomes a CTCP ACTION.
+qqEntityRegex = re.compile(u'&(?:#([0-9]+)|#[xX]([0-9a-fA-F]+)|([A-Za-z][A-Za-z0-9]*));|\xa0')
+
+# numeric references to surrogates, C0 controls (CR and LF would end the
+# IRC line) and past the last code point stay as they are
+def codepoint_(number):
+    if number < 0x20 or 0xD800 <= number <= 0xDFFF or number > 0x10FFFF:
+        raise ValueError(number)
+    return unichr(number)
+
+def qqEntity_(match):
+    (decimal, hexadecimal, name) = match.groups()
+    try:
+        if decimal:
+            return codepoint_(int(decimal))
+        if hexadecimal:
+            return codepoint_(int(hexadecimal, 16))
+        if name:
+            return unichr(name2codepoint[name]) if name != 'nbsp' else ' '
+    except (KeyError, ValueError, OverflowError):
+        return match.group(0)
+    return ' '
+
+ACTION_PREFIX = '/me '
+
+# returns (text, isAction)
+def qqToIrc(text):
+    if u'&' in text or u'\xa0' in text:
+        text = qqEntityRegex.sub(qqEntity_, text)
+    if text.startswith(ACTION_PREFIX):
+        return (text[len(ACTION_PREFIX):], True)
+    return (text, False)
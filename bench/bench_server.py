@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Times the IRCServer hot paths against an in-process fake QQBot and prints
+# the results as JSON, one object per case, so runs can be compared.
+#
+#   python bench/bench_server.py [--groups N] [--members N] [--clients N]
+#                                [--repeat N] [--output results.json]
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from qqbot.mainloop import StartDaemonThread, MainLoop
+
+from fakebot import FakeQQBot
+from IRCProtocol import parseMessage
+from IRCServer import IRCClientBase, IRCServerBase, UniqNameMap
+
+class BenchServer(IRCServerBase):
+    def __init__(self, bot):
+        self.setupServer(bot)
+
+# runs its sender tasks inline and discards the output
+class BenchClient(IRCClientBase):
+    def __init__(self, server, nick):
+        self.server = server
+        self.client_address = ('bench', 0)
+        self.written = 0
+        self.setupClient()
+        for line in ['PASS x', 'NICK ' + nick, 'USER %s 0 * :bench' % nick,
+                     'PROTOCTL NAMESX NAMEDCHANNEL', 'JOIN #']:
+            self.processLine(line)
+
+    def sender_putIn(self, lane, f, *args, **kwargs):
+        self.runTask_(lane, f, args, kwargs)
+
+    def sender_exit(self):
+        pass
+
+    def reader_exit(self):
+        pass
+
+    def abortConnection(self):
+        pass
+
+    def writeChunks(self, chunks):
+        self.written += sum(len(chunk) for chunk in chunks)
+
+# best of `repeat` rounds of `number` calls
+def timeCase(name, func, number, repeat, **params):
+    best = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        for _ in range(number):
+            func()
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = {
+        'name': name,
+        'number': number,
+        'repeat': repeat,
+        'best': best,
+        'usPerCall': best / number * 1e6,
+        'callsPerSecond': number / best if best else None,
+    }
+    result.update(params)
+    sys.stderr.write('%-28s %12.2f us/call\n' % (name, result['usPerCall']))
+    return result
+
+ircLines = [
+    'PING :qq.bot',
+    ':nick!user@host PRIVMSG #channel :hello there, how is everyone doing today?',
+    '@time=2024-01-01T00:00:00.000Z;msgid=abc :nick!user@host NOTICE nick :\x02bold\x02 text',
+    'PRIVMSG #a,#b,nick :\x0304,01colour\x03 and \x1ditalics\x1d',
+]
+
+colouredLines = [
+    u'hello world',
+    u'\x02important:\x02 meeting moved to \x0304,01 15:00 \x03 tomorrow',
+    u'你好，今天晚上一起吃饭吗？\x0304红色\x03的部分是重点',
+]
+
+def run(args):
+    bot = FakeQQBot(groups=args.groups, members=args.members, buddies=args.buddies,
+                    distinctNames=args.distinct_names)
+    server = BenchServer(bot)
+    client = BenchClient(server, 'bench')
+    clients = [client] + [BenchClient(server, 'bench%d' % i) for i in range(args.clients - 1)]
+    group = bot.groups[0]
+    channel = client.channelNames.toIRC[group.qq]
+    member = bot.members[group.qq][1]
+    (repeat, n) = (args.repeat, args.number)
+
+    results = []
+    results.append(timeCase('parseMessage', lambda: [parseMessage(line) for line in ircLines],
+                            n * 10, repeat, lines=len(ircLines)))
+    results.append(timeCase('processLine PONG', lambda: client.processLine('PONG :qq.bot'),
+                            n * 10, repeat))
+    results.append(timeCase('stripColorCode',
+                            lambda: [server.stripColorCode(line) for line in colouredLines],
+                            n * 10, repeat, lines=len(colouredLines)))
+
+    names = [(m.name, m.qq) for m in bot.members[group.qq]]
+    def register():
+        nameMap = UniqNameMap(server, False)
+        for (name, qq) in names:
+            nameMap.register(name, qq)
+    results.append(timeCase('UniqNameMap.register', register, max(1, n // 100), repeat,
+                            names=len(names), distinctNames=args.distinct_names or args.members))
+
+    results.append(timeCase('doNAMES', lambda: client.doNAMES(channel), max(1, n // 10), repeat,
+                            members=args.members))
+    results.append(timeCase('doWHO', lambda: client.doWHO(channel), max(1, n // 100), repeat,
+                            members=args.members))
+    results.append(timeCase('doLIST', lambda: client.doLIST(), max(1, n // 10), repeat,
+                            groups=args.groups))
+    results.append(timeCase('onQQMessage fan-out',
+                            lambda: server.deliverQQMessage_(time.time(), group, member, u'hello\nworld'),
+                            n, repeat, clients=len(clients)))
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'time': time.time(),
+        'params': vars(args),
+        'listCalls': bot.listCalls,
+        'results': results,
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Time the IRCServer hot paths.')
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--buddies', type=int, default=200)
+    parser.add_argument('--distinct-names', type=int, default=200,
+                        help='distinct member names per group, to force collisions')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--number', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args(argv[1:])
+
+    StartDaemonThread(MainLoop)
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
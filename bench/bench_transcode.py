@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Compares Transcoder against the regex / str.replace chains it replaced.
+#
+#   python bench/bench_transcode.py [iterations]
+
+import os
+import re
+import sys
+import timeit
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+
+from Transcoder import ircToQQ, qqToIrc
+
+colorRegex = re.compile(r'\x03[0-9]{1,2}(?:,[0-9]{1,2})?')
+hiddenRegex = re.compile(r'\x030,0.*')
+colorModeRegex = re.compile(r'\x03|\x02|\x16|\x1F|\x1D')
+def oldStripColorCode(content):
+    content = hiddenRegex.sub('', content)
+    content = colorRegex.sub('', content)
+    content = colorModeRegex.sub('', content)
+    return content
+
+def oldDecode(content):
+    content = content.replace('&lt;', '<')
+    content = content.replace('&gt;', '>')
+    return content
+
+plainIrcSamples = [
+    u'hi all',
+    u'anyone tried the new build? it segfaults on startup for me',
+    u'你好，今天晚上一起吃饭吗？',
+]
+
+formattedIrcSamples = [
+    u'\x02important:\x02 meeting moved to \x0304,01 15:00 \x03 tomorrow',
+    u'\x0312https://example.com/some/long/path?with=query&and=more\x0f see above',
+    u'\x1dquoting\x1d: \x1fthe\x1f \x16whole\x16 thing \x0309green\x03 and \x0300,00hidden',
+    u'你好，今天晚上一起吃饭吗？\x0304红色\x03的部分是重点',
+]
+
+plainQQSamples = [
+    u'收到',
+    u'今天天气不错，适合出去走走。晚上有人打球吗？',
+    u'/me waves',
+]
+
+entityQQSamples = [
+    u'std::vector&lt;int&gt; v; v.push_back(1);',
+    u'a &amp;&amp; b || c &lt;= d, see &quot;docs&quot;\xa0ok',
+    u'笑死&#128512;',
+]
+
+def bench(name, func, samples, number):
+    seconds = timeit.timeit(lambda: [func(sample) for sample in samples], number=number)
+    perCall = seconds / (number * len(samples)) * 1e6
+    print('%-24s %8.3f us/call' % (name, perCall))
+    return perCall
+
+def compare(title, oldName, old, newName, new, samples, number):
+    print(title)
+    before = bench(oldName, old, samples, number)
+    after = bench(newName, new, samples, number)
+    print('%-24s %8.2fx' % ('speedup', before / after))
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 20000
+    compare('IRC -> QQ, plain text', 'stripColorCode (old)', oldStripColorCode,
+            'ircToQQ', ircToQQ, plainIrcSamples, number)
+    compare('IRC -> QQ, formatted text', 'stripColorCode (old)', oldStripColorCode,
+            'ircToQQ', ircToQQ, formattedIrcSamples, number)
+    # the old chain only decoded &lt; and &gt;
+    compare('QQ -> IRC, plain text', 'replace chain (old)', oldDecode,
+            'qqToIrc', qqToIrc, plainQQSamples, number)
+    compare('QQ -> IRC, entities', 'replace chain (old)', oldDecode,
+            'qqToIrc', qqToIrc, entityQQSamples, number)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# In-process stand-in for a logged-in QQBot: List/SendTo/conf over a
+# generated contact table, no network.
+
+class FakeContact(object):
+    def __init__(self, ctype, qq, name, **attrs):
+        self.ctype = ctype
+        self.qq = qq
+        self.uin = 'u' + qq
+        self.name = name
+        self.nick = name
+        self.mark = ''
+        self.__dict__.update(attrs)
+
+class FakeConf(object):
+    def __init__(self, qq, **options):
+        self.qq = qq
+        self.__dict__.update(options)
+
+class FakeQQBot(object):
+    # `distinctNames` < `members` makes member names collide within a group
+    def __init__(self, groups=10, members=500, buddies=100, distinctNames=None,
+                 qq='10000', **options):
+        self.conf = FakeConf(qq, **options)
+        distinctNames = distinctNames or members
+        self.groups = [FakeContact('group', str(900000 + i), u'群%d' % i, gcode='gc%d' % i)
+                       for i in range(groups)]
+        self.members = {}
+        for (i, group) in enumerate(self.groups):
+            rows = [FakeContact('group-member', str(1000000 + i * members + j),
+                                u'成员%d' % (j % distinctNames), role_id=j % 3)
+                    for j in range(members)]
+            rows.append(FakeContact('group-member', qq, 'me', role_id=0))
+            self.members[group.qq] = rows
+        self.buddies = [FakeContact('buddy', str(500000 + j), 'buddy%d' % j)
+                        for j in range(buddies)]
+        self.listCalls = 0
+        self.sent = 0
+
+    def List(self, tinfo, cinfo=None):
+        self.listCalls += 1
+        if tinfo == 'group':
+            rows = self.groups
+        elif tinfo == 'buddy':
+            rows = self.buddies
+        else:
+            rows = self.members.get(tinfo.qq)
+            if rows is None:
+                return None
+        if cinfo is not None:
+            rows = [row for row in rows if row.qq == cinfo]
+        return list(rows)
+
+    def SendTo(self, contact, content):
+        self.sent += 1
+        return u'向 %s 发消息成功' % contact.name
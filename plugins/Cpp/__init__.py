@@ -45,7 +45,9 @@ __author__ = supybot.authors.jemfinch
 __contributors__ = {}
 
 import config
+import sandbox
 import plugin
+reload(sandbox)
 reload(plugin) # In case we're being reloaded.
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
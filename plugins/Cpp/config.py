@@ -46,10 +46,50 @@ class Networks(registry.SpaceSeparatedListOf):
     List = ircutils.IrcSet
     Value = registry.String
 
+class Backend(registry.OnlySomeStrings):
+    validStrings = ('geordi', 'local')
+
 Cpp = conf.registerPlugin('Cpp')
 conf.registerGlobalValue(Cpp, 'channels',
     conf.SpaceSeparatedSetOfChannels([], """Determines which channels the bot
         handle << and {} as cpp"""))
+conf.registerGlobalValue(Cpp, 'maxOutstanding',
+    registry.PositiveInteger(3, """Determines how many snippets may be waiting
+        for geordi at once; further snippets are queued."""))
+conf.registerGlobalValue(Cpp, 'timeout',
+    registry.PositiveInteger(15, """Determines how many seconds to wait for
+        geordi to answer a snippet."""))
+conf.registerGlobalValue(Cpp, 'cacheSize',
+    registry.NonNegativeInteger(256, """Determines how many results are kept,
+        keyed by the snippet without leading and trailing whitespace.  0
+        disables the cache."""))
+conf.registerGlobalValue(Cpp, 'backend',
+    Backend('geordi', """Determines where snippets are evaluated: by geordi
+        on FreeNode, or by compiling and running them on this machine."""))
 
+conf.registerGroup(Cpp, 'local')
+conf.registerGlobalValue(Cpp.local, 'compiler',
+    registry.String('g++', """Determines the compiler used by the local
+        backend."""))
+conf.registerGlobalValue(Cpp.local, 'flags',
+    registry.String('-std=c++17 -O1 -w', """Determines the compiler flags
+        used by the local backend.  The prelude is precompiled with the same
+        flags."""))
+conf.registerGlobalValue(Cpp.local, 'workers',
+    registry.PositiveInteger(2, """Determines how many processes compile and
+        run snippets at once."""))
+conf.registerGlobalValue(Cpp.local, 'cpuTime',
+    registry.PositiveInteger(2, """Determines how many seconds of CPU time a
+        snippet may use."""))
+conf.registerGlobalValue(Cpp.local, 'memory',
+    registry.PositiveInteger(256, """Determines how many megabytes of address
+        space a snippet may use."""))
+conf.registerGlobalValue(Cpp.local, 'jail',
+    registry.String('bwrap', """Determines the bubblewrap executable the
+        compiler and snippets are run under.  The local backend refuses to
+        run snippets without it."""))
+conf.registerGlobalValue(Cpp.local, 'cacheDir',
+    registry.String('', """Determines where compiled snippets are kept.  If
+        empty, a Cpp directory in the bot's data directory is used."""))
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -30,10 +30,12 @@
 
 import time
 import re
+import collections
 
 import supybot.conf as conf
 import supybot.utils as utils
 import supybot.world as world
+import supybot.schedule as schedule
 from supybot.commands import *
 import supybot.irclib as irclib
 import supybot.ircmsgs as ircmsgs
@@ -41,6 +43,19 @@ import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
 from supybot.utils.structures import MultiSet, TimeoutQueue
 
+from . import sandbox
+
+class Request(object):
+    """One snippet sent to a backend and everyone waiting for its result."""
+    def __init__(self, key, code, backend):
+        self.key = key
+        self.code = code
+        self.backend = backend
+        self.callers = []
+        self.event = None
+        # when it timed out while geordi still owed its reply
+        self.abandoned = None
+
 class Cpp(callbacks.PluginRegexp):
     callBefore = ['Dunno']
     addressedRegexps = ['matchCode', 'cpp']
@@ -49,6 +64,29 @@ class Cpp(callbacks.PluginRegexp):
     def __init__(self, irc):
         self.__parent = super(Cpp, self)
         self.__parent.__init__(irc)
+        # geordi answers in order, so replies are matched to the oldest
+        # request sent to it; requests that timed out keep their place there
+        # so that a late reply is dropped, not given to the next one
+        self._waiting = collections.deque()
+        self._inFlight = collections.deque()
+        self._geordi = collections.deque()
+        # a request timed out since geordi last owed nothing: replies may
+        # be matched to the wrong request, so they are not cached
+        self._unsure = False
+        self._requests = {}
+        self._cache = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._timeouts = 0
+        self._eventId = 0
+        self._sandbox = None
+
+    def die(self):
+        for request in self._inFlight:
+            self._cancelTimeout(request)
+        if self._sandbox is not None:
+            self._sandbox.close()
+        self.__parent.die()
 
     def enable(self, irc, msg, args, channel):
         """[<channel>]
@@ -70,26 +108,154 @@ class Cpp(callbacks.PluginRegexp):
         irc.replySuccess()
     disable = wrap(disable, ['channel'])
 
+    def stats(self, irc, msg, args):
+        """takes no arguments
+
+        Returns the result cache hits and misses and the requests in flight.
+        """
+        irc.reply(format('%n, %n, %n cached, %i in flight, %i waiting, %n',
+                         (self._hits, 'hit'), (self._misses, 'miss'),
+                         (len(self._cache), 'result'), len(self._inFlight),
+                         len(self._waiting), (self._timeouts, 'timeout')))
+    stats = wrap(stats)
+
     def inFilter(self, irc, msg):
         if msg.command == 'PRIVMSG':
             replyTo = ircutils.replyTo(msg)
             if replyTo == "geordi" and irc.network == "FreeNode":
                 (me, text) = msg.args
-                self._replyIrc.queueMsg(callbacks.reply(self._replyMsg, text))
+                self._dropLost()
+                if self._geordi:
+                    request = self._geordi.popleft()
+                    if request.abandoned is None:
+                        self._done(request, text, not self._unsure)
+                if not self._geordi:
+                    self._unsure = False
                 return None
         return msg
 
+    def _dropLost(self):
+        # a reply still owed after another timeout is taken as lost
+        lost = time.time() - self.registryValue('timeout')
+        while self._geordi and self._geordi[0].abandoned is not None and \
+              self._geordi[0].abandoned < lost:
+            self._geordi.popleft()
+
+    def _getSandbox(self):
+        if self._sandbox is None:
+            cacheDir = self.registryValue('local.cacheDir') or \
+                       conf.supybot.directories.data.dirize('Cpp')
+            settings = {
+                'compiler': self.registryValue('local.compiler'),
+                'flags': self.registryValue('local.flags').split(),
+                'cacheDir': cacheDir,
+                'cpuTime': self.registryValue('local.cpuTime'),
+                'memory': self.registryValue('local.memory') << 20,
+                'timeout': self.registryValue('local.cpuTime') * 2,
+                'compileTimeout': 60,
+                'compileMemory': 2048 << 20,
+                'outputLimit': 400,
+                'cacheEntries': 1000,
+                'jail': self.registryValue('local.jail'),
+            }
+            self._sandbox = sandbox.Sandbox(settings,
+                                            self.registryValue('local.workers'))
+        return self._sandbox
+
+    def _normalize(self, code):
+        return code.strip()
+
     def _forwardRequest(self, irc, msg, code):
-        freeNode = world.getIrc("FreeNode")
-        if not freeNode:
-            irc.reply("not connected to geordi yet")
+        key = self._normalize(code)
+        if key in self._cache:
+            self._hits += 1
+            result = self._cache.pop(key)
+            self._cache[key] = result
+            irc.reply(result)
             return
+        self._misses += 1
 
+        request = self._requests.get(key)
+        if request is None:
+            backend = self.registryValue('backend')
+            if backend == 'geordi' and not world.getIrc("FreeNode"):
+                irc.reply("not connected to geordi yet")
+                return
+            if backend == 'local':
+                try:
+                    self._getSandbox()
+                except sandbox.Unavailable as e:
+                    irc.error(str(e))
+                    return
+            request = self._requests[key] = Request(key, code, backend)
+            self._waiting.append(request)
         irc.noReply()
-        self._replyIrc = irc
-        self._replyMsg = msg
+        request.callers.append((irc, msg))
+        self._sendWaiting()
+
+    def _sendWaiting(self):
+        freeNode = world.getIrc("FreeNode")
+        while self._waiting and \
+              len(self._inFlight) < self.registryValue('maxOutstanding'):
+            request = self._waiting.popleft()
+            if request.backend == 'geordi' and not freeNode:
+                self._finish(request, "not connected to geordi yet", False)
+                continue
+            self._eventId += 1
+            request.event = 'Cpp.timeout.%s' % self._eventId
+            schedule.addEvent(lambda request=request: self._timeout(request),
+                              time.time() + self.registryValue('timeout'),
+                              request.event)
+            self._inFlight.append(request)
+            if request.backend == 'local':
+                # the result arrives on a pool thread; hand it to the
+                # driver like everything else
+                self._getSandbox().submit(request.code,
+                    lambda text, request=request: schedule.addEvent(
+                        lambda: self._done(request, text), 0))
+            else:
+                self._geordi.append(request)
+                freeNode.queueMsg(ircmsgs.privmsg("geordi", request.code))
+
+    def _done(self, request, text, cache=True):
+        try:
+            self._inFlight.remove(request)
+        except ValueError:
+            return
+        self._cancelTimeout(request)
+        self._finish(request, text, cache)
+        self._sendWaiting()
+
+    def _cancelTimeout(self, request):
+        try:
+            schedule.removeEvent(request.event)
+        except KeyError:
+            pass
+
+    def _timeout(self, request):
+        try:
+            self._inFlight.remove(request)
+        except ValueError:
+            return
+        self._timeouts += 1
+        if request.backend == 'local':
+            self._finish(request, "the snippet did not finish in time", False)
+        else:
+            request.abandoned = time.time()
+            self._unsure = True
+            self._dropLost()
+            self._finish(request, "geordi did not answer in time", False)
+        self._sendWaiting()
 
-        freeNode.queueMsg(ircmsgs.privmsg("geordi", code))
+    def _finish(self, request, text, cache):
+        del self._requests[request.key]
+        size = self.registryValue('cacheSize')
+        if cache and size:
+            self._cache[request.key] = text
+            while len(self._cache) > size:
+                self._cache.popitem(last=False)
+        for (irc, msg) in request.callers:
+            irc.queueMsg(callbacks.reply(msg, text))
 
     def matchCode(self, irc, msg, match):
         r"^(<<.*|\{.*\}.*)$"
@@ -0,0 +1,324 @@
+"""
+Compiles and runs snippets on the local machine, geordi style.
+
+Snippets are wrapped into a program, compiled against a precompiled prelude
+and run in a pool of worker processes under CPU, memory and file size
+limits.  Binaries (and compiler errors) are cached under the hash of
+everything that went into them, so a repeated snippet is only run; the least
+recently used ones go past `cacheEntries`.
+
+Both the compiler and the snippet run under bubblewrap, in their own user,
+pid, network and mount namespaces, seeing only the system directories
+read-only, a private /tmp and the files they need: the compiler its work
+directory, the snippet nothing but its own binary.  Neither can see the
+bot's files or the cache.  Without bubblewrap the backend is not available.
+"""
+
+import os
+import re
+import signal
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PRELUDE = """\
+#include <bits/stdc++.h>
+using namespace std;
+"""
+
+def _topLevel(code, start, stops):
+    """Returns the index of the first character of `stops` at nesting depth
+    zero in `code` from `start`, skipping string and character literals, or
+    -1."""
+    depth = 0
+    i = start
+    while i < len(code):
+        c = code[i]
+        if c in '"\'':
+            i += 1
+            while i < len(code) and code[i] != c:
+                i += 2 if code[i] == '\\' else 1
+        elif depth == 0 and c in stops:
+            return i
+        elif c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+        i += 1
+    return -1
+
+def wrap(code):
+    """Turns a snippet into a program the way geordi does:
+
+        << expr; declarations    prints expr
+        { statements } declarations
+    """
+    code = code.strip()
+    if code.startswith('<<'):
+        end = _topLevel(code, 2, ';')
+        if end < 0:
+            (expr, decls) = (code[2:], '')
+        else:
+            (expr, decls) = (code[2:end], code[end + 1:])
+        body = 'std::cout << %s;' % expr
+    elif code.startswith('{'):
+        end = _topLevel(code, 1, '}')
+        if end < 0:
+            (body, decls) = (code[1:], '')
+        else:
+            (body, decls) = (code[1:end], code[end + 1:])
+    else:
+        (body, decls) = ('', code)
+    return '%s\nint main() {\n%s\n}\n' % (decls, body)
+
+class Unavailable(Exception):
+    pass
+
+def _limits(cpu, memory, fileSize=None):
+    """Returns a preexec_fn starting a new session (so that the whole
+    process group can be killed) under the given limits."""
+    def apply():
+        os.setsid()
+        if resource is None:
+            return
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        if fileSize is not None:
+            resource.setrlimit(resource.RLIMIT_FSIZE, (fileSize, fileSize))
+    return apply
+
+def _jail(settings, argv, binds, cwd='/tmp'):
+    """Returns `argv` run under bubblewrap with only the system directories
+    and `binds`, (source, destination, writable) triples, visible."""
+    jail = [settings['jail'], '--unshare-all', '--die-with-parent',
+            '--new-session', '--ro-bind', '/usr', '/usr']
+    for path in ('/bin', '/lib', '/lib32', '/lib64', '/etc/alternatives',
+                 '/etc/ld.so.cache'):
+        jail += ['--ro-bind-try', path, path]
+    jail += ['--proc', '/proc', '--dev', '/dev', '--tmpfs', '/tmp',
+             '--clearenv', '--setenv', 'PATH', '/usr/bin:/bin']
+    for (source, destination, writable) in binds:
+        jail += ['--bind' if writable else '--ro-bind', source, destination]
+    return jail + ['--chdir', cwd, '--'] + argv
+
+def _run(argv, cwd, timeout, limits, maxOutput):
+    """Returns (output, returncode, timedOut).  Reading stops, and the
+    process group is killed, after `maxOutput` bytes or `timeout`
+    seconds."""
+    process = subprocess.Popen(argv, cwd=cwd, preexec_fn=limits,
+                               stdin=open(os.devnull, 'rb'),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    timedOut = []
+    def kill():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    def expire():
+        timedOut.append(True)
+        kill()
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    chunks = []
+    size = 0
+    try:
+        while size < maxOutput:
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        if size >= maxOutput:
+            kill()
+        process.stdout.close()
+        process.wait()
+    finally:
+        timer.cancel()
+    output = b''.join(chunks)[:maxOutput]
+    returncode = process.returncode
+    if returncode > 128:
+        # bubblewrap exits with 128 + the signal that killed its child
+        returncode = 128 - returncode
+    return (output.decode('utf-8', 'replace'), returncode, bool(timedOut))
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def _publish(path, data):
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+_errorRegex = re.compile(r'^[^:\n]*:\d+:\d+: (?:fatal )?error: (.*)$', re.M)
+
+def _compileError(output):
+    match = _errorRegex.search(output)
+    if match:
+        return 'error: ' + match.group(1)
+    return output.strip().split('\n')[0] or 'compilation failed'
+
+def _compilerLimits(settings, timeout):
+    return _limits(int(timeout) + 1, settings['compileMemory'])
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def _prune(settings):
+    """Removes the least recently used binaries and errors beyond
+    `cacheEntries`."""
+    directory = settings['cacheDir']
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith('prelude-') or name.startswith('tmp'):
+            continue
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            pass
+    entries.sort()
+    for (mtime, path) in entries[:max(0, len(entries) - settings['cacheEntries'])]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _prelude(settings):
+    """Returns the directory holding the prelude header, precompiling it on
+    first use."""
+    key = _hash(settings['compiler'], ' '.join(settings['flags']), PRELUDE)
+    directory = os.path.join(settings['cacheDir'], 'prelude-' + key[:16])
+    header = os.path.join(directory, 'prelude.hpp')
+    if not os.path.exists(header + '.gch'):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        _publish(header, PRELUDE.encode('utf-8'))
+        (fd, gch) = tempfile.mkstemp(dir=directory, suffix='.gch')
+        os.close(fd)
+        try:
+            (output, returncode, timedOut) = _run(
+                _jail(settings, [settings['compiler']] + settings['flags'] +
+                      ['-x', 'c++-header', 'prelude.hpp',
+                       '-o', os.path.basename(gch)],
+                      [(directory, '/prelude', True)], '/prelude'),
+                directory, 120, _compilerLimits(settings, 120), 65536)
+            if returncode == 0:
+                os.rename(gch, header + '.gch')
+        finally:
+            if os.path.exists(gch):
+                os.remove(gch)
+    return directory
+
+def evaluate(code, settings):
+    """Compiles (unless cached) and runs `code`; returns the line to say.
+    Runs in a worker process."""
+    try:
+        return _evaluate(code, settings)
+    except Exception as e:
+        return 'internal error: %s' % e
+
+def _evaluate(code, settings):
+    source = wrap(code)
+    prelude = _prelude(settings)
+    key = _hash(settings['compiler'], ' '.join(settings['flags']), PRELUDE,
+                source)
+    binary = os.path.join(settings['cacheDir'], key)
+    if os.path.exists(binary + '.err'):
+        _touch(binary + '.err')
+        with open(binary + '.err', 'rb') as f:
+            return f.read().decode('utf-8', 'replace')
+
+    work = tempfile.mkdtemp(prefix='cpp-')
+    try:
+        if not os.path.exists(binary):
+            with open(os.path.join(work, 'snippet.cpp'), 'wb') as f:
+                f.write(source.encode('utf-8'))
+            (output, returncode, timedOut) = _run(
+                _jail(settings, [settings['compiler']] + settings['flags'] +
+                      ['-include', '/prelude/prelude.hpp', 'snippet.cpp',
+                       '-o', 'snippet'],
+                      [(prelude, '/prelude', False), (work, '/work', True)],
+                      '/work'),
+                work, settings['compileTimeout'],
+                _compilerLimits(settings, settings['compileTimeout']), 65536)
+            if timedOut or returncode == -signal.SIGXCPU:
+                return 'compilation timed out'
+            if returncode != 0:
+                error = _compileError(output)
+                _publish(binary + '.err', error.encode('utf-8'))
+                _prune(settings)
+                return error
+            os.chmod(os.path.join(work, 'snippet'), 0o755)
+            os.rename(os.path.join(work, 'snippet'), binary)
+            _prune(settings)
+        else:
+            _touch(binary)
+
+        (output, returncode, timedOut) = _run(
+            _jail(settings, ['/snippet'], [(binary, '/snippet', False)]),
+            work, settings['timeout'],
+            _limits(settings['cpuTime'], settings['memory'], 1 << 20),
+            settings['outputLimit'] + 1)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    output = ' '.join(output.split('\n')).strip()
+    if timedOut:
+        output += ' [timed out]'
+    elif returncode < 0:
+        output += ' [signal %d]' % -returncode
+    output = output.strip() or '[no output]'
+    if len(output) > settings['outputLimit']:
+        output = output[:settings['outputLimit']] + '...'
+    return output
+
+def _which(program):
+    if os.path.dirname(program):
+        return program if os.access(program, os.X_OK) else None
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+class Sandbox(object):
+    """A pool of worker processes evaluating snippets with `evaluate`."""
+    def __init__(self, settings, workers):
+        jail = _which(settings['jail'])
+        if jail is None:
+            raise Unavailable('the local backend needs bubblewrap (%s) to '
+                              'isolate snippets' % settings['jail'])
+        self.settings = dict(settings, jail=jail)
+        if not os.path.isdir(settings['cacheDir']):
+            os.makedirs(settings['cacheDir'])
+        self.pool = multiprocessing.Pool(workers)
+
+    def submit(self, code, callback):
+        """Evaluates `code` and calls `callback` with the result, from
+        another thread."""
+        self.pool.apply_async(evaluate, (code, self.settings),
+                              callback=callback)
+
+    def close(self):
+        self.pool.terminate()
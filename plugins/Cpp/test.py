@@ -29,9 +29,68 @@
 
 from supybot.test import *
 
+import supybot.schedule as schedule
+
 class CppTestCase(PluginTestCase):
     plugins = ('Cpp',)
 
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        # geordi is asked on FreeNode; let the test network be it
+        self.irc.network = 'FreeNode'
+        self.geordiTimeout = conf.supybot.plugins.Cpp.timeout()
 
-# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
+    def tearDown(self):
+        conf.supybot.plugins.Cpp.timeout.setValue(self.geordiTimeout)
+        PluginTestCase.tearDown(self)
+
+    def assertAsksGeordi(self, query, code, **kwargs):
+        m = self.getMsg(query, **kwargs)
+        self.failUnless(m, 'Nothing was sent to geordi.')
+        self.assertEqual(m.args, ('geordi', code))
+
+    def geordiSays(self, text):
+        self.irc.feedMsg(ircmsgs.privmsg(self.irc.nick, text,
+                                         prefix='geordi!geordi@geordi'))
+        return self.irc.takeMsg()
+
+    def testCache(self):
+        self.assertAsksGeordi('<< 1+2', '<< 1+2')
+        self.assertEqual(self.geordiSays('3').args[1], '3')
+        self.assertResponse('  << 1+2 ', '3')
+        # whitespace inside literals matters
+        self.assertAsksGeordi('<< "a  b"', '<< "a  b"')
+        self.assertEqual(self.geordiSays('a  b').args[1], 'a  b')
+        self.assertAsksGeordi('<< "a b"', '<< "a b"')
+        self.assertEqual(self.geordiSays('a b').args[1], 'a b')
 
+    def testTimeout(self):
+        conf.supybot.plugins.Cpp.timeout.setValue(1)
+        self.assertAsksGeordi('<< 1', '<< 1')
+        timeFastForward(1.1)
+        schedule.run()
+        self.assertEqual(self.irc.takeMsg().args[1],
+                         'geordi did not answer in time')
+
+        # the late reply to << 1 is not taken for << 2, and << 2 is not
+        # cached while it is unclear which reply is which
+        self.assertAsksGeordi('<< 2', '<< 2')
+        self.assertEqual(self.geordiSays('1'), None)
+        self.assertEqual(self.geordiSays('2').args[1], '2')
+        self.assertAsksGeordi('<< 2', '<< 2')
+        self.assertEqual(self.geordiSays('2').args[1], '2')
+        self.assertResponse('<< 2', '2')
+
+    def testLocalNeedsJail(self):
+        backend = conf.supybot.plugins.Cpp.backend()
+        jail = conf.supybot.plugins.Cpp.local.jail()
+        try:
+            conf.supybot.plugins.Cpp.backend.setValue('local')
+            conf.supybot.plugins.Cpp.local.jail.setValue('/nonexistent/bwrap')
+            self.assertError('<< 1')
+        finally:
+            conf.supybot.plugins.Cpp.backend.setValue(backend)
+            conf.supybot.plugins.Cpp.local.jail.setValue(jail)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
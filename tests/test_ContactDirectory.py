@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+#   python -m unittest discover tests
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+
+try:
+    from ContactDirectory import ContactDirectory
+    from Fetcher import FetchTimeout
+except ImportError:
+    ContactDirectory = None
+
+class Server(object):
+    class fetcher(object):
+        timeout = 5
+
+@unittest.skipIf(ContactDirectory is None, 'qqbot is not installed')
+class ContactDirectoryTest(unittest.TestCase):
+    # callers waiting on a first load that fails get no empty directory
+    def testWaitersOfAFailedFirstLoadRaise(self):
+        directory = ContactDirectory(Server())
+        waiting = threading.Event()
+        def load():
+            waiting.wait(5)
+            raise FetchTimeout("timed out waiting for QQ")
+        directory.load = load
+
+        errors = []
+        def ensure():
+            try:
+                directory.ensure()
+            except FetchTimeout as e:
+                errors.append(e)
+        threads = [threading.Thread(target=ensure) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        while directory.loading is None:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        waiting.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(directory.generation, 0)
+
+if __name__ == '__main__':
+    unittest.main()
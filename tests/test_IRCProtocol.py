@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+#   python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+
+from IRCProtocol import LineFramer, commandTable, parseMessage, splitEncoded
+
+class LineFramerTest(unittest.TestCase):
+    def testLines(self):
+        framer = LineFramer(64)
+        self.assertEqual(framer.feed(b'NICK foo\r\nUSER a'), ['NICK foo'])
+        self.assertEqual(framer.feed(b' b c :d\nPING x\r\n'), ['USER a b c :d', 'PING x'])
+        self.assertEqual(framer.feed(b'\r\n\n'), [])
+
+    def testSplitUTF8(self):
+        framer = LineFramer(64)
+        data = u'PRIVMSG #a :中文\r\n'.encode('utf8')
+        self.assertEqual(framer.feed(data[:14]), [])
+        self.assertEqual(framer.feed(data[14:]), [u'PRIVMSG #a :中文'])
+
+    def testOverlongLineIsDroppedWhole(self):
+        framer = LineFramer()
+        data = b'PRIVMSG #a :' + b'A' * 16372 + b'QUIT :smuggled\r\nPING x\r\n'
+        self.assertEqual(framer.feed(data), ['PING x'])
+
+    def testOverlongLineAcrossFeeds(self):
+        framer = LineFramer(64)
+        self.assertEqual(framer.feed(b'PING a\r\n' + b'A' * 100), ['PING a'])
+        self.assertEqual(framer.feed(b'B' * 100), [])
+        self.assertEqual(framer.feed(b'QUIT :smuggled\r\nPING b\r\n'), ['PING b'])
+
+class ParseMessageTest(unittest.TestCase):
+    def testPlain(self):
+        message = parseMessage(u'privmsg #a :hello  world ')
+        self.assertEqual((message.tags, message.prefix, message.command, message.params),
+                         (None, None, 'PRIVMSG', ['#a', 'hello  world ']))
+
+    def testTagsAndPrefix(self):
+        message = parseMessage(u'@time=2020-01-01T00:00:00.000Z;msgid=a\\:b\\sc\\\\;+flag;x=\\ '
+                               u':nick!user@host JOIN #a')
+        self.assertEqual(message.tags, {'time': '2020-01-01T00:00:00.000Z', 'msgid': 'a;b c\\',
+                                        '+flag': '', 'x': ''})
+        self.assertEqual(message.prefix, 'nick!user@host')
+        self.assertEqual((message.command, message.params), ('JOIN', ['#a']))
+
+    def testTrailing(self):
+        self.assertEqual(parseMessage(u'PRIVMSG #a ::) :x').params, ['#a', ':) :x'])
+        self.assertEqual(parseMessage(u'USER a b c :real name').params, ['a', 'b', 'c', 'real name'])
+        self.assertEqual(parseMessage(u'NICK  foo').params, ['foo'])
+
+    def testEmptyParams(self):
+        self.assertEqual(parseMessage(u'PING :').params, [''])
+        self.assertEqual(parseMessage(u'TOPIC #a :').params, ['#a', ''])
+        self.assertEqual(parseMessage(u'LIST').params, [])
+
+    def testNoCommand(self):
+        self.assertEqual(parseMessage(u''), None)
+        self.assertEqual(parseMessage(u':nick!user@host'), None)
+        self.assertEqual(parseMessage(u'@a=b'), None)
+        self.assertEqual(parseMessage(u'@a=b :nick '), None)
+
+class Handlers(object):
+    def doNICK(self, nick):
+        return ('NICK', nick)
+    def doJOIN(self, channels, keys=None):
+        return ('JOIN', channels, keys)
+    def doPING(self, *args):
+        return ('PING',) + args
+    def helper(self):
+        pass
+
+class CommandTableTest(unittest.TestCase):
+    def testArity(self):
+        table = commandTable(Handlers, r'do([A-Z]+)$')
+        self.assertEqual(sorted(table), ['JOIN', 'NICK', 'PING'])
+        self.assertEqual(table['NICK'][1:], (1, 1))
+        self.assertEqual(table['JOIN'][1:], (1, 2))
+        self.assertEqual(table['PING'][1:], (0, None))
+
+    def testDispatch(self):
+        table = commandTable(Handlers, r'do([A-Z]+)$')
+        handlers = Handlers()
+        self.assertEqual(table['JOIN'][0](handlers, '#a'), ('JOIN', '#a', None))
+        self.assertEqual(table['PING'][0](handlers, 'x', 'y'), ('PING', 'x', 'y'))
+
+class SplitEncodedTest(unittest.TestCase):
+    def testFits(self):
+        self.assertEqual(splitEncoded(b'hello', 5), [b'hello'])
+        self.assertEqual(splitEncoded(b'', 5), [b''])
+
+    def testUTF8Boundary(self):
+        data = u'中文中文'.encode('utf8')
+        pieces = splitEncoded(data, 7)
+        self.assertEqual(pieces, [u'中文'.encode('utf8'), u'中文'.encode('utf8')])
+        self.assertEqual([piece.decode('utf8') for piece in splitEncoded(u'a中文中'.encode('utf8'), 5)],
+                         [u'a中', u'文', u'中'])
+
+    def testWordBoundary(self):
+        # the space a piece is cut at is dropped
+        self.assertEqual(splitEncoded(b'the quick brown fox jumps', 20),
+                         [b'the quick brown fox', b'jumps'])
+        # a space early in the piece is no better than a hard cut
+        self.assertEqual(splitEncoded(b'a bcdefghij', 8), [b'a bcdefg', b'hij'])
+
+    def testLongWord(self):
+        self.assertEqual(splitEncoded(b'abcdefghij', 4), [b'abcd', b'efgh', b'ij'])
+        # a character longer than the budget is cut where it has to be
+        self.assertEqual(splitEncoded(u'中中'.encode('utf8'), 2),
+                         [b'\xe4\xb8', b'\xad', b'\xe4\xb8', b'\xad'])
+
+if __name__ == '__main__':
+    unittest.main()
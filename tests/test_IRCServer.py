@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+#   python -m unittest discover tests
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+
+try:
+    import IRCServer
+except ImportError:
+    IRCServer = None
+
+class Contact(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class Conf(object):
+    qq = '10000'
+    IRCClientMaxOutputBytes = 1 << 20
+    IRCBacklogMessages = 100000
+    IRCBacklogBytes = 1 << 20
+
+# 60 groups of 50 members; lookups run on the caller's thread
+class Bot(object):
+    conf = Conf()
+
+    def __init__(self):
+        self.groups = [Contact(qq='9%d' % i, uin='u9%d' % i, name='grp%d' % i, nick='G %d' % i,
+                               mark='', gcode='gc%d' % i, ctype='group') for i in range(60)]
+        me = Contact(qq='10000', uin='me', name='me', role_id=0, ctype='group-member')
+        self.members = dict((group.qq, [Contact(qq=str(1000 + j), uin='m%d' % j, name='nick%d' % j,
+                                                role_id=j % 3, ctype='group-member')
+                                        for j in range(50)] + [me])
+                            for group in self.groups)
+
+    def Put(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+    def List(self, tinfo, cinfo=None):
+        if tinfo == 'group':
+            contacts = self.groups
+        elif tinfo == 'buddy':
+            contacts = []
+        else:
+            contacts = self.members[tinfo.qq]
+        return [contact for contact in contacts if cinfo is None or contact.qq == cinfo]
+
+    def SendTo(self, contact, content):
+        return 'ok'
+
+@unittest.skipIf(IRCServer is None, 'qqbot is not installed')
+class QQMessageTest(unittest.TestCase):
+    def testActionIsTheFirstLineOnly(self):
+        message = IRCServer.QQMessage(None, None, u'/me waves\nhello')
+        self.assertEqual(message.render('a!b@c', '#x', False),
+                         b':a!b@c PRIVMSG #x :\x01ACTION waves\x01\r\n'
+                         b':a!b@c PRIVMSG #x :hello\r\n')
+        self.assertEqual(message.render('a!b@c', '#x', True),
+                         b':a!b@c PRIVMSG +all+ :\x01ACTION #x: waves\x01\r\n'
+                         b':a!b@c PRIVMSG +all+ :#x: hello\r\n')
+
+    def testSurrogateReferenceIsSentAsText(self):
+        message = IRCServer.QQMessage(None, None, u'&#xD83D;&#xDE00;')
+        self.assertEqual(message.render('a!b@c', '#x', False),
+                         b':a!b@c PRIVMSG #x :&#xD83D;&#xDE00;\r\n')
+
+@unittest.skipIf(IRCServer is None, 'qqbot is not installed')
+class OutputBufferTest(unittest.TestCase):
+    # nothing to flush for a line that was dropped or refused
+    def testDroppedLineSchedulesNoFlush(self):
+        output = IRCServer.OutputBuffer(maxBytes=100, policy='drop')
+        self.assertEqual(output.append(b'x' * 60 + b'\r\n', '#a'), IRCServer.bulk(None))
+        self.assertEqual(output.append(b'y' * 60 + b'\r\n', '#a'), None)
+        self.assertEqual(output.dropped, 1)
+
+        output = IRCServer.OutputBuffer(maxBytes=100)
+        self.assertEqual(output.append(b'x' * 120 + b'\r\n'), IRCServer.OutputBuffer.overflow)
+        self.assertEqual(output.append(b'PONG x\r\n'), None)
+
+    def testFlushCounters(self):
+        output = IRCServer.OutputBuffer()
+        output.append(b'a\r\nb\r\n')
+        output.append(b'c\r\n', '#a')
+        self.assertEqual(output.take(), ([b'a\r\nb\r\n', b'c\r\n'], None))
+        self.assertEqual(output.take(), ([], None))
+        self.assertEqual((output.flushes, output.lines, output.bytes, output.maxFlushLines),
+                         (1, 3, 9, 3))
+
+@unittest.skipIf(IRCServer is None, 'qqbot is not installed')
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = Bot()
+        self.server = IRCServer.IRCServer(self.bot, ('127.0.0.1', 0))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # what the server sent until it fell silent for `timeout` seconds
+    def converse(self, data, timeout=1):
+        connection = socket.create_connection(self.server.server_address)
+        connection.sendall(data)
+        connection.settimeout(timeout)
+        data = b''
+        try:
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        connection.close()
+        return data
+
+    # commands are checked against their handler's arity before they run
+    def testDispatch(self):
+        data = self.converse(b'NICK\r\nPASS x\r\nNICK foo\r\nUSER a b c :real\r\n'
+                             b'PROTOCTL NAMEDCHANNEL\r\nPART\r\nPING a b\r\nFOO x\r\nNICK bar baz\r\n')
+        self.assertIn(b':qq.bot 461 * NICK :Not enough parameters\r\n', data)
+        self.assertIn(b' PART :Not enough parameters\r\n', data)
+        self.assertIn(b':qq.bot PONG a :b\r\n', data)
+        self.assertIn(b' FOO :Unknown command\r\n', data)
+        # NICK takes one parameter; the rest is cut off
+        self.assertIn(b':foo!10000@qq.com NICK :bar\r\n', data)
+        self.assertIn(b' 001 foo ', data)
+
+    # the replay of JOIN # is larger than the SendQ, but it is the client's
+    # own doing and the client reads it
+    def testReadingClientSurvivesJoinAll(self):
+        for i in range(4000):
+            group = self.bot.groups[i % 60]
+            self.server.onQQMessage(group, self.bot.members[group.qq][i % 50],
+                                    'backlog %d %s' % (i, 'y' * 200))
+        deadline = time.time() + 10
+        while self.server.ingest.depth() and time.time() < deadline:
+            time.sleep(0.05)
+
+        data = self.converse(b'PASS x\r\nNICK foo\r\nUSER a b c :real\r\n'
+                             b'PROTOCTL NAMESX NAMEDCHANNEL\r\nJOIN #\r\n', 3)
+
+        self.assertGreater(len(data), Conf.IRCClientMaxOutputBytes)
+        self.assertNotIn(b'SendQ exceeded', data)
+        self.assertEqual(data.count(b' PRIVMSG '), 4000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+#   python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+
+from Transcoder import ircToQQ, qqToIrc
+
+class QQToIrcTest(unittest.TestCase):
+    def testEntities(self):
+        self.assertEqual(qqToIrc(u'&lt;b&gt; &amp;&nbsp;&#20013;&#x6587;&#x1F600;\xa0'),
+                         (u'<b> & 中文\U0001F600 ', False))
+
+    def testUnknownEntityIsKept(self):
+        self.assertEqual(qqToIrc(u'&bogus; &'), (u'&bogus; &', False))
+
+    def testSurrogatesAreKept(self):
+        self.assertEqual(qqToIrc(u'&#55357;&#xDE00;'), (u'&#55357;&#xDE00;', False))
+        self.assertEqual(qqToIrc(u'&#xD83D;x')[0].encode('utf8'), b'&#xD83D;x')
+
+    def testPastLastCodePointIsKept(self):
+        self.assertEqual(qqToIrc(u'&#1114112;&#x110000;&#99999999999999999999;'),
+                         (u'&#1114112;&#x110000;&#99999999999999999999;', False))
+
+    def testControlsAreKept(self):
+        self.assertEqual(qqToIrc(u'a&#13;&#10;QUIT&#0;&#x1;'), (u'a&#13;&#10;QUIT&#0;&#x1;', False))
+
+    def testAction(self):
+        self.assertEqual(qqToIrc(u'/me waves'), (u'waves', True))
+        self.assertEqual(qqToIrc(u'say /me'), (u'say /me', False))
+
+class IrcToQQTest(unittest.TestCase):
+    def testFormatting(self):
+        self.assertEqual(ircToQQ(u'\x02bold\x02 \x0304,01red\x03 \x1fu\x0f'), u'bold red u')
+        self.assertEqual(ircToQQ(u'plain'), u'plain')
+
+    def testHiddenText(self):
+        self.assertEqual(ircToQQ(u'shown \x0300,00hidden'), u'shown ')
+
+if __name__ == '__main__':
+    unittest.main()